@@ -0,0 +1,66 @@
+#
+# Measures how long justify_rows (pig.py --fit) takes to lay out albums of the given
+# sizes with a random mix of thumb aspect ratios, and checks that every row except the
+# last is exactly the row width.
+#
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pig
+
+class Thumb(object):
+	def __init__(self, width, height):
+		self.thumb_width = width
+		self.thumb_height = height
+
+aspect_ratios = ((4, 3), (3, 4), (3, 2), (2, 3), (16, 9), (9, 16), (1, 1), (3, 1))
+
+def make_thumbs(n, thumb_height, rng):
+	thumbs = []
+	for _ in range(n):
+		w, h = rng.choice(aspect_ratios)
+		if w < h:
+			thumbs.append(Thumb(thumb_height, round(thumb_height * h / w)))
+		else:
+			thumbs.append(Thumb(round(thumb_height * w / h), thumb_height))
+	return thumbs
+
+def check_rows(rows, row_width):
+	bad = 0
+	for row in rows[:-1]:
+		if sum(thumb.thumb_width + pig.thumb_spacing for thumb in row) != row_width:
+			bad += 1
+	return bad
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-c', '--cols', type=int, default=4)
+	parser.add_argument('-s', '--seed', type=int, default=1)
+	parser.add_argument('sizes', nargs='*', type=int, default=[1000, 10000, 50000])
+	args = parser.parse_args()
+
+	thumb_width, thumb_height = 360, 270
+	row_width = args.cols * (thumb_width + pig.thumb_spacing)
+	rng = random.Random(args.seed)
+	failed = False
+
+	for n in args.sizes:
+		thumbs = make_thumbs(n, thumb_height, rng)
+		start = time.perf_counter()
+		rows = pig.justify_rows(thumbs, row_width, thumb_height)
+		elapsed = time.perf_counter() - start
+		bad = check_rows(rows, row_width)
+		heights = [max(thumb.thumb_height for thumb in row) for row in rows[:-1]] or [0]
+		print(f'{n} thumbs: {elapsed:.3f}s ({elapsed/n*1e6:.1f}us/thumb), {len(rows)} rows,'
+			f' height {min(heights)}-{max(heights)}, {bad} rows not {row_width} wide')
+		failed = failed or bad or sum(map(len, rows)) != n
+
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
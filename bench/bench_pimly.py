@@ -0,0 +1,84 @@
+#
+# Measures the time and memory that pimly.Image takes to parse the given images, and
+# the time to then read the tags that pig.py uses. With -j, also parses the images in
+# that many threads and checks that every tag value matches the serial parse.
+#
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pimly
+
+pig_tags = (
+	(271,), (272,), (274,), (34665, 33434), (34665, 33437), (34665, 34855),
+	(34665, 36867), (34665, 37386), (34665, 42036),
+)
+
+def read_tags(image):
+	for path in pig_tags:
+		d = image.exifData
+		for tag in path:
+			if not d or not (v := d.get(tag)):
+				break
+			d = v.value
+
+def time_parse(paths, repeat):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		images = [pimly.Image(path) for path in paths]
+		parsed = time.perf_counter()
+		for image in images:
+			read_tags(image)
+		done = time.perf_counter()
+		if not best or done - start < best[0] + best[1]:
+			best = parsed - start, done - parsed
+	return best
+
+def measure_memory(paths):
+	tracemalloc.start()
+	images = [pimly.Image(path) for path in paths]
+	size, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return size
+
+def all_values(ifdData):
+	return {tag: all_values(v.value) if isinstance(v.value, dict) else v.value
+		for tag, v in ifdData.items()}
+
+def snapshot(path):
+	image = pimly.Image(path)
+	return image.size, image.exifData and (image.byteOrder, all_values(image.exifData))
+
+def check_threads(paths, jobs):
+	expected = [snapshot(path) for path in paths]
+	start = time.perf_counter()
+	with ThreadPoolExecutor(jobs) as executor:
+		results = list(executor.map(snapshot, paths))
+	elapsed = time.perf_counter() - start
+	bad = sum(1 for a, b in zip(expected, results) if a != b)
+	print(f'{jobs} threads: {elapsed/len(paths)*1e6:.1f}us/image, {bad} mismatches')
+	return bad
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-r', '--repeat', type=int, default=3)
+	parser.add_argument('-j', '--jobs', type=int, default=0)
+	parser.add_argument('imagePath', nargs='+')
+	args = parser.parse_args()
+
+	paths = args.imagePath
+	n = len(paths)
+	parse, access = time_parse(paths, args.repeat)
+	size = measure_memory(paths)
+	print(f'{n} images: parse {parse/n*1e6:.1f}us/image, pig tags {access/n*1e6:.1f}us/image,'
+		f' {size/n/1024:.1f}KB/image retained')
+	if args.jobs and check_threads(paths, args.jobs):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,82 @@
+#
+# Compares rendering page_template.html and index_template.html with the
+# temple interpreter (Template.write) and with the compiled template.
+#
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import temple
+
+class Obj(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+def make_images(n):
+	dirs = Obj(images='images', thumbs='thumbs')
+	return [Obj(number=i, page=f'page{i:03}.html', index_page='index.html', dir=dirs,
+		web_originals='originals_web', web_name=f'IMG_{i:04}.webp', width=920, height=690,
+		thumb_width=360, thumb_height=270, size_px='4032x3024', size_mb='2.1MB',
+		time='5/1/23 10:00am', camera='iPhone 14 Pro',
+		camera_info='iPhone 14 Pro, ISO50, 24mm, &fnof;1.78, 1/120s') for i in range(1, n + 1)]
+
+def page_vars(spec, images):
+	for image in images:
+		yield {'spec': spec, 'image': image, 'num_images': len(images), 'half_width': 460,
+			'caption': '', 'prev_page': 'page001.html', 'next_page': 'page002.html',
+			'prev_link': True, 'next_link': True}
+
+def index_vars(spec, images, cols=2, rows=60):
+	per_page = cols * rows
+	for i in range(0, len(images), per_page):
+		page = images[i:i + per_page]
+		yield {'spec': spec, 'table': [page[j:j + cols] for j in range(0, len(page), cols)],
+			'fit': False, 'number': '1/1'}
+
+def time_render(template, varmaps):
+	start = time.perf_counter()
+	for varmap in varmaps:
+		with io.StringIO() as output:
+			template.write(output, varmap)
+	return time.perf_counter() - start
+
+def bench(path, make_vars, repeat):
+	with open(path) as file:
+		data = file.read()
+	interpreted = temple.parse(data, path=path)
+	compiled = temple.parse(data, compile=True, path=path)
+
+	for template in (interpreted, compiled):
+		outputs = []
+		for varmap in make_vars():
+			with io.StringIO() as output:
+				template.write(output, varmap)
+				outputs.append(output.getvalue())
+		if template is interpreted:
+			expected = outputs
+		else:
+			assert outputs == expected, f'Compiled output for {path} differs'
+
+	t1 = min(time_render(interpreted, make_vars()) for _ in range(repeat))
+	t2 = min(time_render(compiled, make_vars()) for _ in range(repeat))
+	print(f'{os.path.basename(path)}: interpreted {t1:.3f}s, compiled {t2:.3f}s ({t1/t2:.1f}x)')
+	return t1, t2
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--num-images', type=int, default=2000)
+	parser.add_argument('-r', '--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	spec = Obj(title='Benchmark', date='2023', overview='')
+	images = make_images(args.num_images)
+
+	bench(os.path.join(root, 'page_template.html'), lambda: page_vars(spec, images), args.repeat)
+	bench(os.path.join(root, 'index_template.html'), lambda: index_vars(spec, images), args.repeat)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# Stands in for magick (and "magick identify") when benchmarking pig.py: it tracks the
+# image sizes through the operations that pig.py uses and writes header-only JPEG, PNG,
+# or WebP files that pimly can read. FAKE_MAGICK_LATENCY adds that many seconds to each
+# command, and FAKE_MAGICK_BYTES sets how many filler bytes follow each output's header.
+#
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pimly
+
+filler_size = int(os.environ.get('FAKE_MAGICK_BYTES', 1000))
+
+def write_image(path, width, height):
+	ext = path.rsplit('.', 1)[-1].lower()
+	if ext in ('jpg', 'jpeg'):
+		sof = struct.pack('>BHHB', 8, height, width, 3) + bytes(9)
+		app0 = b'JFIF\0\x01\x01\0\0\x01\0\x01\0\0'
+		data = b''.join((b'\xff\xd8\xff\xe0', struct.pack('>H', len(app0) + 2), app0,
+			b'\xff\xc0', struct.pack('>H', len(sof) + 2), sof))
+	elif ext == 'png':
+		ihdr = b'IHDR' + struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+		data = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + ihdr + bytes(4)
+	else:
+		vp8x = b'VP8X' + struct.pack('<II', 10, 0) + (width - 1).to_bytes(3, 'little') \
+			+ (height - 1).to_bytes(3, 'little')
+		data = b'RIFF' + struct.pack('<I', len(vp8x) + 4) + b'WEBP' + vp8x
+	with open(path, 'wb') as file:
+		file.write(data + bytes(filler_size))
+
+def read_size(path):
+	size = pimly.Image(path).size
+	return list(size) if size else [4032, 3024]
+
+def resize(size, geometry):
+	if geometry.endswith('!'):
+		size[:] = map(int, geometry[:-1].split('x'))
+	elif geometry.endswith('>'):
+		width, height = map(int, geometry[:-1].split('x'))
+		scale = min(width / size[0], height / size[1])
+		if scale < 1:
+			size[:] = round(size[0] * scale), round(size[1] * scale)
+	else:
+		width = int(geometry)
+		size[:] = width, round(width * size[1] / size[0])
+
+# Options that take an argument which doesn't change the size of the image
+skip_options = {'-background', '-define', '-depth', '-gravity', '-quality', '-unsharp'}
+
+def convert(args):
+	stack = [[]]
+	i = 0
+	while i < len(args):
+		arg = args[i]
+		i += 1
+		images = stack[-1]
+		if arg == '(':
+			stack.append([])
+		elif arg == ')':
+			images = stack.pop()
+			stack[-1].extend(images)
+		elif arg == '+clone':
+			images.append(list(stack[-2][-1]))
+		elif arg == '+delete':
+			images.pop()
+		elif arg == '-resize':
+			resize(images[-1], args[i])
+			i += 1
+		elif arg == '-crop':
+			images[-1][:] = map(int, args[i].split('+')[0].split('x'))
+			i += 1
+		elif arg == '-rotate':
+			if args[i] in ('90', '-90', '270'):
+				images[-1].reverse()
+			i += 1
+		elif arg in skip_options:
+			i += 1
+		elif arg in ('+append', '-append'):
+			axis = 0 if arg == '+append' else 1
+			size = [max(image[0] for image in images), max(image[1] for image in images)]
+			size[axis] = sum(image[axis] for image in images)
+			images[:] = [size]
+		elif arg == '-write':
+			if not args[i].startswith('mpr:'):
+				write_image(args[i], *images[-1])
+			i += 1
+		elif i == len(args) and len(stack) == 1:
+			if arg.endswith(':-'):
+				width, height = images[-1]
+				sys.stdout.buffer.write(bytes(k * 37 % 256 for k in range(width * height * 3)))
+			elif arg != 'null:':
+				write_image(arg, *images[-1])
+		elif not arg.startswith(('-', '+', 'mpr:')):
+			images.append(read_size(arg))
+
+def main():
+	if latency := float(os.environ.get('FAKE_MAGICK_LATENCY', 0)):
+		time.sleep(latency)
+	args = sys.argv[1:]
+	if args and args[0] == 'identify':
+		for path in args[1:]:
+			width, height = read_size(path)
+			print(path, 'WEBP', f'{width}x{height}', f'{width}x{height}+0+0', '8-bit sRGB')
+	else:
+		convert(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,192 @@
+#
+# Writes a synthetic album for benchmarking: header-only JPEGs with Exif (in both byte
+# orders, with an IFD1 thumbnail), PNGs with XMP, and WebPs (VP8 and VP8X with Exif and
+# XMP) followed by filler bytes in place of the compressed image data, and a spec.py that
+# has pig.py use bench/fake_magick.py for magick and identify.
+#
+import os
+import random
+import struct
+import zlib
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+templates = ('index_template.html', 'page_template.html', 'style_template.css',
+	'viewer_template.html')
+
+def encode_value(p, kind, value):
+	if kind in (1, 2, 7): # BYTE, ASCII, UNDEFINED
+		return value, len(value)
+	if fmt := {3: 'H', 4: 'I', 9: 'i'}.get(kind):
+		return struct.pack(p + fmt * len(value), *value), len(value)
+	fmt = 'II' if kind == 5 else 'ii' # RATIONAL or SRATIONAL
+	return b''.join(struct.pack(p + fmt, *v) for v in value), len(value)
+
+def ifd_bytes(p, entries, offset, next_ifd=0):
+	# Each entry is (tag, type, value), where the value of a sub-IFD is a list of entries
+	entries = sorted(entries, key=lambda entry: entry[0])
+	end = offset + 2 + 12 * len(entries) + 4
+	fields, data = [], b''
+	for tag, kind, value in entries:
+		if isinstance(value, list):
+			fields.append(struct.pack(p + 'HHII', tag, 4, 1, end + len(data)))
+			data += ifd_bytes(p, value, end + len(data))
+			continue
+		payload, count = encode_value(p, kind, value)
+		if len(payload) <= 4:
+			fields.append(struct.pack(p + 'HHI', tag, kind, count) + payload.ljust(4, b'\0'))
+		else:
+			fields.append(struct.pack(p + 'HHII', tag, kind, count, end + len(data)))
+			data += payload + b'\0' * (len(payload) & 1)
+	return struct.pack(p + 'H', len(entries)) + b''.join(fields) + struct.pack(p + 'I', next_ifd) + data
+
+def ascii(s):
+	return 2, s.encode() + b'\0'
+
+def exif_bytes(rng, big_endian, timestamp, thumbnail):
+	p = '>' if big_endian else '<'
+	r = rng.randint
+	date = '{:04}:{:02}:{:02} {:02}:{:02}:{:02}'.format(*timestamp)
+	exif = [
+		(33434, 5, ((1, r(10, 4000)),)), # ExposureTime
+		(33437, 5, ((r(150, 280), 100),)), # FNumber
+		(34850, 3, (2,)), # ExposureProgram
+		(34855, 3, (r(25, 3200),)), # PhotographicSensitivity
+		(36864, 7, b'0232'), # ExifVersion
+		(36867, *ascii(date)), # DateTimeOriginal
+		(36868, *ascii(date)), # DateTimeDigitized
+		(37377, 10, ((r(-1000, 1000), 100),)), # ShutterSpeedValue
+		(37386, 5, ((r(150, 900), 100),)), # FocalLength
+		(37500, 7, rng.randbytes(r(500, 3000))), # MakerNote
+		(40961, 3, (65535,)), # ColorSpace
+		(41989, 3, (rng.choice((13, 24, 48, 77)),)), # FocalLengthIn35mmFilm
+		(42036, *ascii('iPhone 14 Pro back triple camera 6.86mm f/1.78')), # LensModel
+	]
+	gps = [
+		(1, *ascii('N')), (2, 5, ((37, 1), (r(0, 59), 1), (r(0, 5999), 100))),
+		(3, *ascii('W')), (4, 5, ((122, 1), (r(0, 59), 1), (r(0, 5999), 100))),
+		(5, 1, b'\0'), (6, 5, ((r(0, 99999), 100),)),
+	]
+	ifd0 = [
+		(271, *ascii('Apple')), (272, *ascii('iPhone 14 Pro')), (274, 3, (1,)),
+		(282, 5, ((72, 1),)), (283, 5, ((72, 1),)), (296, 3, (2,)), (305, *ascii('17.1')),
+		(306, *ascii(date)), (316, *ascii('iPhone 14 Pro')), (34665, 4, exif), (34853, 4, gps),
+	]
+	# IFD1 describes the embedded JPEG thumbnail, which follows it
+	ifd1_offset = 8 + len(ifd_bytes(p, ifd0, 8))
+	ifd1 = [(259, 3, (6,)), (282, 5, ((72, 1),)), (283, 5, ((72, 1),)), (296, 3, (2,)),
+		(513, 4, (0,)), (514, 4, (len(thumbnail),))]
+	ifd1[4] = (513, 4, (ifd1_offset + len(ifd_bytes(p, ifd1, ifd1_offset)),))
+	return b''.join(((b'MM' if big_endian else b'II'), struct.pack(p + 'HI', 42, 8),
+		ifd_bytes(p, ifd0, 8, ifd1_offset), ifd_bytes(p, ifd1, ifd1_offset), thumbnail))
+
+def xmp_bytes(timestamp):
+	date = '{:04}-{:02}-{:02}T{:02}:{:02}:{:02}'.format(*timestamp)
+	return ('<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+		' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+		'  <rdf:Description rdf:about="" xmlns:photoshop="http://ns.adobe.com/photoshop/1.0/">\n'
+		f'   <photoshop:DateCreated>{date}</photoshop:DateCreated>\n'
+		'  </rdf:Description>\n'
+		' </rdf:RDF>\n'
+		'</x:xmpmeta>\n').encode()
+
+def jpeg_bytes(width, height, exif, filler):
+	app1 = b'Exif\0\0' + exif
+	dqt = b'\0' + bytes(range(64))
+	sof = struct.pack('>BHHB', 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+	return b''.join((b'\xff\xd8',
+		b'\xff\xe1', struct.pack('>H', len(app1) + 2), app1,
+		b'\xff\xdb', struct.pack('>H', len(dqt) + 2), dqt,
+		b'\xff\xc0', struct.pack('>H', len(sof) + 2), sof,
+		filler, b'\xff\xd9'))
+
+def png_chunk(kind, data):
+	return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def png_bytes(width, height, xmp, filler):
+	return b''.join((b'\x89PNG\r\n\x1a\n',
+		png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+		png_chunk(b'iTXt', b'XML:com.adobe.xmp\0\0\0\0\0' + xmp),
+		png_chunk(b'IDAT', filler),
+		png_chunk(b'IEND', b'')))
+
+def riff_chunk(kind, data):
+	return kind + struct.pack('<I', len(data)) + data + b'\0' * (len(data) & 1)
+
+def webp_bytes(width, height, exif, xmp, filler):
+	vp8 = riff_chunk(b'VP8 ', b'\x50\x2a\x00\x9d\x01\x2a'
+		+ struct.pack('<HH', width, height) + filler)
+	if exif:
+		flags = 0x08 | (0x04 if xmp else 0)
+		vp8x = struct.pack('<I', flags) + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')
+		chunks = riff_chunk(b'VP8X', vp8x) + riff_chunk(b'EXIF', b'Exif\0\0' + exif)
+		if xmp:
+			chunks += riff_chunk(b'XMP ', xmp)
+		vp8 = chunks + vp8
+	return b'RIFF' + struct.pack('<I', len(vp8) + 4) + b'WEBP' + vp8
+
+def write_spec(root, n):
+	magick = os.path.join(bench_dir, 'fake_magick.py')
+	with open(os.path.join(root, 'spec.py'), 'w') as file:
+		file.write(f'title = {"Benchmark (" + str(n) + " images)"!r}\n'
+			"date = ''\n"
+			'width = 920\n'
+			'height = 690\n'
+			'thumb_width = 360\n'
+			'thumb_height = 270\n'
+			'thumb_cols = 4\n'
+			'thumb_rows = 30\n'
+			f'magick = {magick!r}\n'
+			"identify = [magick, 'identify']\n")
+
+def make_corpus(root, n, seed=1, filler_size=4096, thumbnail_size=16384):
+	"""Write n images to root/originals (JPEGs and PNGs, which pig.py builds an album
+	from) and root/webp (which only pimly reads), a spec.py, and copies of the templates."""
+	rng = random.Random(seed)
+	filler = rng.randbytes(filler_size)
+	thumbnail = b'\xff\xd8' + rng.randbytes(thumbnail_size) + b'\xff\xd9'
+	for name in ('originals', 'webp'):
+		os.makedirs(os.path.join(root, name), exist_ok=True)
+
+	for i in range(n):
+		width, height = rng.choice(((4032, 3024), (3024, 4032), (4032, 2268), (3024, 3024)))
+		timestamp = (2023, rng.randint(1, 12), rng.randint(1, 28),
+			rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+		kind = i % 10
+		if kind < 7:
+			path = os.path.join(root, 'originals', f'IMG_{i:06}.JPG')
+			data = jpeg_bytes(width, height, exif_bytes(rng, i % 2 == 0, timestamp, thumbnail), filler)
+		elif kind < 9:
+			path = os.path.join(root, 'originals', f'IMG_{i:06}.PNG')
+			data = png_bytes(width, height, xmp_bytes(timestamp), filler)
+		else:
+			path = os.path.join(root, 'webp', f'IMG_{i:06}.webp')
+			exif = exif_bytes(rng, i % 20 == 9, timestamp, thumbnail) if i % 30 != 9 else None
+			data = webp_bytes(width, height, exif, exif and xmp_bytes(timestamp), filler)
+		with open(path, 'wb') as file:
+			file.write(data)
+
+	write_spec(root, n)
+	copy_templates(root)
+
+def copy_templates(root):
+	for name in templates:
+		with open(os.path.join(root_dir, name)) as file:
+			data = file.read()
+		with open(os.path.join(root, name), 'w') as file:
+			file.write(data)
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--num-images', type=int, default=1000)
+	parser.add_argument('-s', '--seed', type=int, default=1)
+	parser.add_argument('--filler', type=int, default=4096)
+	parser.add_argument('--thumbnail', type=int, default=16384)
+	parser.add_argument('root')
+	args = parser.parse_args()
+
+	make_corpus(args.root, args.num_images, args.seed, args.filler, args.thumbnail)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,159 @@
+#
+# Runs the benchmarks on synthetic albums (see make_corpus.py) of the given sizes:
+# pimly.Image parsing, rendering the page and index templates, justify_rows, and
+# pig.py builds (cold, then warm) with fake_magick.py in place of magick. The results
+# can be saved as a baseline, and a later run compared against it fails (exit status 1)
+# if any timing regressed by more than the threshold.
+#
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, root_dir)
+import pig
+import temple
+
+import bench_layout
+import bench_pimly
+import bench_temple
+import make_corpus
+
+corpus_files = {'originals', 'webp', 'spec.py', 'corpus.json', *make_corpus.templates}
+
+def prepare_corpus(work_dir, n, seed):
+	root = os.path.join(work_dir, str(n))
+	marker = os.path.join(root, 'corpus.json')
+	info = {'num_images': n, 'seed': seed}
+	try:
+		with open(marker) as file:
+			reuse = json.load(file) == info
+	except FileNotFoundError:
+		reuse = False
+	if not reuse:
+		shutil.rmtree(root, ignore_errors=True)
+		make_corpus.make_corpus(root, n, seed)
+		with open(marker, 'w') as file:
+			json.dump(info, file)
+	else:
+		# Always benchmark the current templates
+		make_corpus.copy_templates(root)
+	return root
+
+def clean_corpus(root):
+	for name in os.listdir(root):
+		if name not in corpus_files:
+			path = os.path.join(root, name)
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			else:
+				os.remove(path)
+
+def bench_parse(root):
+	paths = [os.path.join(root, name, file_name) for name in ('originals', 'webp')
+		for file_name in sorted(os.listdir(os.path.join(root, name)))]
+	parse, access = bench_pimly.time_parse(paths, 3)
+	return {'pimly.parse': parse, 'pimly.tags': access}
+
+def bench_render(n):
+	spec = bench_temple.Obj(title='Benchmark', date='2023', width=920, height=690)
+	images = bench_temple.make_images(n)
+	results = {}
+	for name, make_vars in (('page', bench_temple.page_vars), ('index', bench_temple.index_vars)):
+		path = os.path.join(root_dir, f'{name}_template.html')
+		with open(path) as file:
+			template = temple.parse(file.read(), compile=True, path=path)
+		results[f'temple.{name}'] = min(bench_temple.time_render(template, make_vars(spec, images))
+			for _ in range(3))
+	return results
+
+def bench_justify(n, seed):
+	thumb_width, thumb_height = 360, 270
+	thumbs = bench_layout.make_thumbs(n, thumb_height, random.Random(seed))
+	start = time.perf_counter()
+	pig.justify_rows(thumbs, 4 * (thumb_width + pig.thumb_spacing), thumb_height)
+	return {'justify_rows': time.perf_counter() - start}
+
+def run_pig(root, pig_args):
+	# The album's spec.py has to be imported rather than the one next to pig.py
+	command = [sys.executable, '-c', 'import sys; sys.path[:0] = [".", sys.argv.pop(1)];'
+		' import pig; pig.main()', root_dir, *pig_args]
+	start = time.perf_counter()
+	result = subprocess.run(command, cwd=root, capture_output=True, text=True)
+	elapsed = time.perf_counter() - start
+	if result.returncode:
+		sys.stdout.write(result.stdout)
+		sys.stderr.write(result.stderr)
+		sys.exit(f'pig.py failed in {root} with exit status {result.returncode}')
+	return elapsed
+
+def bench_build(root, pig_args):
+	clean_corpus(root)
+	cold = run_pig(root, pig_args)
+	warm = run_pig(root, pig_args)
+	return {'pig.cold': cold, 'pig.warm': warm}
+
+def compare(results, baseline, threshold, min_delta):
+	regressions = 0
+	print(f'{"":24} {"baseline":>10} {"current":>10} {"change":>8}')
+	for name, seconds in results.items():
+		old = baseline.get(name)
+		if old is None:
+			print(f'{name:24} {"":>10} {seconds:10.4f}')
+			continue
+		change = (seconds - old) / old if old else 0
+		regressed = change > threshold and seconds - old > min_delta
+		regressions += regressed
+		print(f'{name:24} {old:10.4f} {seconds:10.4f} {change:+8.1%}{"  REGRESSED" if regressed else ""}')
+	return regressions
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', '--seed', type=int, default=1)
+	parser.add_argument('-w', '--work-dir', default=os.path.join(bench_dir, 'corpus'))
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+	parser.add_argument('--build-max', type=int, default=10000)
+	parser.add_argument('--pig-args', default='--pipeline')
+	parser.add_argument('-o', '--output')
+	parser.add_argument('--baseline')
+	parser.add_argument('--save-baseline')
+	parser.add_argument('--threshold', type=float, default=0.2)
+	parser.add_argument('--min-delta', type=float, default=0.005)
+	parser.add_argument('sizes', nargs='*', type=int, default=[1000, 10000, 100000])
+	args = parser.parse_args()
+
+	pig_args = ['-j', str(args.jobs), *args.pig_args.split()]
+	results = {}
+	for n in args.sizes:
+		root = prepare_corpus(args.work_dir, n, args.seed)
+		timings = {}
+		timings.update(bench_parse(root))
+		timings.update(bench_render(n))
+		timings.update(bench_justify(n, args.seed))
+		# Building runs fake_magick.py several times per image, so the largest albums are skipped
+		if n <= args.build_max:
+			timings.update(bench_build(root, pig_args))
+		for name, seconds in timings.items():
+			results[f'{name}@{n}'] = seconds
+			print(f'{n} images: {name} {seconds:.4f}s')
+
+	if args.output:
+		with open(args.output, 'w') as file:
+			json.dump(results, file, indent='\t')
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as file:
+			json.dump(results, file, indent='\t')
+	if args.baseline:
+		with open(args.baseline) as file:
+			baseline = json.load(file)
+		if compare(results, baseline, args.threshold, args.min_delta):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -1,19 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
+import subprocess
+from pimly import Image
 
-def writeCropList(imageDir):
+def imageSize(path):
+	# The size as a browser displays it, i.e. after applying any Exif orientation
+	image = Image(path)
+	if not image.size:
+		return None
+	width, height = image.size
+	if image.exifData and (tagData := image.exifData.get(274)) and tagData.value[0] > 4:
+		return height, width
+	return width, height
+
+def makeProxy(magick, original, proxy, size):
+	# Proxies get the original's mtime, so a changed original can be detected
+	stat = os.stat(original)
+	if os.path.exists(proxy) and os.stat(proxy).st_mtime_ns == stat.st_mtime_ns:
+		return None
+	command = [magick, original, '-resize', f'{size}x{size}>', proxy]
+	result = subprocess.run(command, capture_output=True)
+	if result.returncode == 0:
+		os.utime(proxy, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+	return command, result
+
+def makeProxies(imageDir, imageNames, imageSizes, proxyDir, proxySizes, magick, jobs):
+	tasks = []
+	for size in proxySizes:
+		sizeDir = os.path.join(proxyDir, str(size))
+		os.makedirs(sizeDir, exist_ok=True)
+		for name in imageNames:
+			# PIE loads the original if it's no larger than the proxy would be
+			if (imageSize := imageSizes.get(name)) and max(imageSize) > size:
+				tasks.append((os.path.join(imageDir, name), os.path.join(sizeDir, name), size))
+
+	made = failed = 0
+	with ThreadPoolExecutor(jobs) as executor:
+		for done in executor.map(lambda task: makeProxy(magick, *task), tasks):
+			if not done:
+				continue
+			command, result = done
+			print(*command)
+			if result.returncode:
+				print(result.stderr.decode(), end='')
+				print('Exit status', result.returncode)
+				failed += 1
+			else:
+				made += 1
+	print(f'Made {made} proxies ({len(tasks) - made - failed} up to date, {failed} failed)')
+
+def writeCropList(imageDir, proxyDir=None, proxySizes=(), magick='magick', jobs=None):
 	imageNames = sorted(name for name in os.listdir(imageDir)
 		if name.endswith(('.webp', '.PNG', '.png', '.JPG', '.jpg')))
+	imageSizes = {}
+	for name in imageNames:
+		if size := imageSize(os.path.join(imageDir, name)):
+			imageSizes[name] = size
+	if proxyDir and proxySizes:
+		makeProxies(imageDir, imageNames, imageSizes, proxyDir, proxySizes, magick, jobs)
+
 	with open('cropList.js', 'w') as f:
 		f.write('var showCropGeometry = true;\n')
 		f.write(f'var imagePath = "{imageDir}/";\n')
 		f.write('var imageNames = [\n')
 		f.write(',\n'.join([f'\t"{name}"' for name in imageNames]))
 		f.write('\n];\n')
+		f.write('var imageSizes = {\n')
+		f.write(',\n'.join([f'\t"{name}": [{w}, {h}]' for name, (w, h) in imageSizes.items()]))
+		f.write('\n};\n')
+		if proxyDir and proxySizes:
+			f.write(f'var proxyPath = "{proxyDir}/";\n')
+			f.write(f'var proxySizes = {json.dumps(sorted(proxySizes))};\n')
 
 if __name__ == '__main__':
 	import argparse
 	parser = argparse.ArgumentParser()
 	parser.add_argument('imageDir', nargs='?', default='originals_web')
+	parser.add_argument('--proxy-dir')
+	parser.add_argument('--no-proxies', dest='proxies', action='store_false')
+	parser.add_argument('--proxy-sizes', default='1280,2560')
+	parser.add_argument('--magick')
+	parser.add_argument('-j', '--jobs', type=int, default=0)
 	args = parser.parse_args()
 
-	writeCropList(args.imageDir)
+	magick = args.magick
+	if not magick:
+		try:
+			import spec
+			magick = getattr(spec, 'magick', None)
+		except ImportError:
+			pass
+	proxySizes = [int(size) for size in args.proxy_sizes.split(',') if size]
+
+	proxyDir = args.proxies and (args.proxy_dir or args.imageDir + '_proxy')
+
+	writeCropList(args.imageDir, proxyDir, proxySizes,
+		magick or '/usr/local/bin/magick', args.jobs or os.cpu_count())
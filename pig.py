@@ -1,25 +1,143 @@
 import argparse
+import base64
 from collections import defaultdict
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import gzip
+import hashlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
 import operator
 import os
+import re
+import resource
 from stat import S_IRUSR, S_IRGRP, S_IROTH, S_IWUSR
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import urllib.parse
+import zlib
 
 from pimly import Image
 import spec as global_spec
 import temple
+try:
+	import brotli
+except ImportError:
+	brotli = None
 
 magick = getattr(global_spec, 'magick', '/usr/local/bin/magick')
 identify = getattr(global_spec, 'identify', [magick, 'identify'])
 magick_mode = getattr(global_spec, 'magick_mode', S_IRUSR | S_IRGRP | S_IROTH | S_IWUSR) # 0o644
 
-def get_image_size(image_path):
+identify_count = 0
+
+album_dir = os.getcwd()
+
+class Profile(object):
+	# With --profile, records the time taken by each stage of the build, and for each
+	# magick command its wall and CPU time, peak RSS, and the bytes read and written
+	file_name = 'pig_profile.json'
+
+	def __init__(self):
+		self.enabled = False
+		self.start = time.perf_counter()
+		self.stages = defaultdict(lambda: [0, 0.0])
+		self.commands = []
+		self.lock = threading.Lock()
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		if not self.enabled:
+			yield
+			return
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - start
+			with self.lock:
+				stage = self.stages[name]
+				stage[0] += 1
+				stage[1] += elapsed
+
+	def run(self, command, conversions, capture_output=False):
+		# Like subprocess.run, but waits with os.wait4 to get the child's own resource usage
+		out_paths = {conversion.out_path for conversion in conversions}
+		in_paths = {conversion.in_path for conversion in conversions} - out_paths
+		in_bytes = sum(os.path.getsize(path) for path in in_paths if os.path.exists(path))
+
+		start = time.perf_counter()
+		with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+			output = (stdout, stderr) if capture_output else (None, None)
+			process = subprocess.Popen(command, stdout=output[0], stderr=output[1])
+			pid, status, usage = os.wait4(process.pid, 0)
+			process.returncode = os.waitstatus_to_exitcode(status)
+			wall = time.perf_counter() - start
+			for file in output:
+				if file:
+					file.seek(0)
+			output = [file.read() if file else None for file in output]
+
+		with self.lock:
+			self.commands.append({
+				'outputs': [conversion.out_path for conversion in conversions],
+				'wall': round(wall, 4),
+				'cpu': round(usage.ru_utime + usage.ru_stime, 4),
+				# ru_maxrss is in kilobytes, except on macOS
+				'max_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+				'in_bytes': in_bytes,
+				'out_bytes': sum(os.path.getsize(path) for path in out_paths if os.path.exists(path)),
+				'returncode': process.returncode,
+			})
+		return subprocess.CompletedProcess(command, process.returncode, *output)
+
+	def report(self, top):
+		children = resource.getrusage(resource.RUSAGE_CHILDREN)
+		stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+		commands = sorted(self.commands, key=lambda command: -command['wall'])
+		report = {
+			'wall': round(time.perf_counter() - self.start, 4),
+			'stages': {name: {'count': count, 'seconds': round(seconds, 4)}
+				for name, (count, seconds) in stages},
+			'children': {
+				'cpu': round(children.ru_utime + children.ru_stime, 4),
+				'max_rss': children.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+			},
+			'commands': commands,
+		}
+		with open(self.file_name, 'w') as file:
+			json.dump(report, file, indent='\t')
+
+		print(f'{"Stage":<24}{"Count":>8}{"Seconds":>10}')
+		for name, (count, seconds) in stages:
+			print(f'{name:<24}{count:>8}{seconds:>10.3f}')
+		if commands:
+			print(f'\n{"Wall":>8}{"CPU":>8}{"RSS MB":>8}{"In MB":>8}{"Out MB":>8}  Slowest outputs')
+			for command in commands[:top]:
+				print(f'{command["wall"]:>8.3f}{command["cpu"]:>8.3f}{command["max_rss"]/1e6:>8.1f}'
+					f'{command["in_bytes"]/1e6:>8.2f}{command["out_bytes"]/1e6:>8.2f}'
+					f'  {", ".join(command["outputs"])}')
+		print(f'Wrote {self.file_name} ({len(commands)} magick commands, {report["wall"]:.2f}s total)')
+
+profile = Profile()
+
+def get_image_size(image_path, cache=None):
+	if cache:
+		return tuple(cache.get('image_size', image_path, get_image_size))
+
 	size = Image(image_path).size
 	if size: return size
 
-	result = subprocess.run([*identify, image_path], capture_output=True, text=True)
+	global identify_count
+	identify_count += 1
+	with profile.stage('identify'):
+		result = subprocess.run([*identify, image_path], capture_output=True, text=True)
 	if result.returncode:
 		sys.exit(f'{" ".join(result.args)} => {result.returncode}')
 
@@ -28,6 +146,102 @@ def get_image_size(image_path):
 	width, height = result[2].split('x')
 	return int(width), int(height)
 
+def png_data_url(width, height, rgb):
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+	row_size = width * 3
+	rows = b''.join(b'\0' + rgb[i:i + row_size] for i in range(0, height * row_size, row_size))
+	png = b''.join((b'\x89PNG\r\n\x1a\n',
+		chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+		chunk(b'IDAT', zlib.compress(rows, 9)),
+		chunk(b'IEND', b'')))
+	return 'data:image/png;base64,' + base64.b64encode(png).decode()
+
+placeholder_size = 4
+
+def get_placeholder(thumb_path, cache=None):
+	# A few pixels that the browser scales up (and smooths) to stand in for the thumb
+	# until it's loaded
+	if cache:
+		return cache.get('placeholder', thumb_path, get_placeholder)
+
+	n = placeholder_size
+	result = subprocess.run([magick, thumb_path, '-resize', f'{n}x{n}!', '-depth', '8', 'rgb:-'],
+		capture_output=True)
+	if result.returncode or len(result.stdout) != n * n * 3:
+		return None
+	return png_data_url(n, n, result.stdout)
+
+def set_placeholders(images, options):
+	jobs = options.scan_jobs or os.cpu_count()
+	thumb_paths = [os.path.join(image.dir.thumbs, image.web_name) for image in images]
+	def placeholder(thumb_path):
+		return os.path.exists(thumb_path) and get_placeholder(thumb_path, options.cache) or ''
+	with ThreadPoolExecutor(jobs) as executor:
+		for image, data_url in zip(images, executor.map(placeholder, thumb_paths)):
+			image.placeholder = data_url
+
+class MetadataCache(object):
+	# Caches what pig.py reads from image files (keyed by absolute path and validated by
+	# size, mtime, and ctime), so that unchanged files don't have to be parsed again. The
+	# ctime catches pimly.py -o and --set, which patch a file in place and keep its mtime.
+	file_name = 'pig_cache.json'
+
+	def __init__(self, enabled=True, verify=False, rebuild=False):
+		self.enabled = enabled
+		self.verify = verify
+		self.entries = {}
+		self.mismatches = 0
+		self.modified = False
+		self.used = set()
+		self.lock = threading.Lock()
+		if enabled and not rebuild and os.path.exists(self.file_name):
+			with open(self.file_name) as file:
+				self.entries = json.load(file)
+		self.path = os.path.abspath(self.file_name)
+
+	def get(self, kind, path, read, stat=None):
+		if not self.enabled:
+			return read(path)
+		stat = stat or os.stat(path)
+		key = os.path.abspath(path)
+		with self.lock:
+			self.used.add(key)
+			entry = self.entries.get(key)
+			if not entry or (entry['size'], entry['mtime_ns'], entry.get('ctime_ns')) != \
+				(stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns):
+				self.entries[key] = entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+					'ctime_ns': stat.st_ctime_ns}
+			# None means the read failed (e.g. magick exited with an error), so it's tried again
+			if entry.get(kind) is not None and not self.verify:
+				return entry[kind]
+
+		# Round-trip through JSON so that a fresh value compares equal to a cached one
+		value = json.loads(json.dumps(read(path)))
+		if value is None:
+			return None
+		with self.lock:
+			if kind in entry and entry[kind] != value:
+				print(f'Cached {kind} for {path} was {entry[kind]} instead of {value}')
+				self.mismatches += 1
+			entry[kind] = value
+			self.modified = True
+		return value
+
+	def save(self):
+		if self.verify:
+			print(f'Metadata cache verified with {self.mismatches} mismatch'
+				f'{"es" if self.mismatches != 1 else ""}')
+		# Drop the entries of files that weren't looked up (e.g. deleted or renamed)
+		if self.enabled and len(self.used) < len(self.entries):
+			self.entries = {key: entry for key, entry in self.entries.items() if key in self.used}
+			self.modified = True
+		if self.modified:
+			with open(self.path + '.tmp', 'w') as file:
+				json.dump(self.entries, file, separators=(',', ':'), sort_keys=True)
+			os.replace(self.path + '.tmp', self.path)
+			self.modified = False
+
 def page_path(n): return f'page{n:03}.html'
 def index_path(n): return 'index.html' if n == 1 else f'index{n:02}.html'
 
@@ -64,23 +278,85 @@ def get_aspect_ratio(w, h):
 def get_dimensions(spec_height, ar_width, ar_height):
 	return int(spec_height * ar_width / ar_height + 0.5), spec_height
 
+def process_exif(d):
+	info = {'camera': '', 'camera_info': '', 'orientation': 0}
+	if not d: return info
+
+	def get_str(key):
+		v = d.get(key)
+		return v.valueType.toStr(v.value) if v else None
+
+	def get_int(key, default=None):
+		v = d.get(key)
+		return v.value[0] if v else default
+
+	info['orientation'] = get_int(274, 0) # Orientation (short)
+
+	make = get_str(271)
+	model = get_str(272)
+	if not (make and model): return info
+	camera = model if model.startswith(make) else f'{make} {model}'
+	camera_info = [camera]
+	if d := d.get(34665):
+		d = d.value
+		if v := d.get(34855): # PhotographicSensitivity (short)
+			a, = v.value
+			camera_info.append(f'ISO{a}')
+		if v := d.get(41989): # FocalLengthIn35mmFilm (short)
+			a, = v.value
+			camera_info.append(f'{a}mm')
+		if v := d.get(33437): # FNumber (rational)
+			(a, b), = v.value
+			camera_info.append(f'&fnof;{a/b:.2f}'.rstrip('.0'))
+		if v := d.get(42082): # SourceExposureTimesOfCompositeImage
+			camera_info.append(v.toStr(v.value, p=1).split(', ')[1] + 's')
+		elif v := d.get(33434): # ExposureTime (rational)
+			(a, b), = v.value
+			camera_info.append(f'{a}/{b}s')
+	info['camera'] = camera
+	info['camera_info'] = ', '.join(camera_info)
+	return info
+
+def read_metadata(info_path):
+	image = Image(info_path)
+	metadata = process_exif(image.exifData)
+	metadata['size'] = image.size
+	metadata['time'] = image.getTimeCreated()
+	if image.format == 'HEIF':
+		# The size already reflects any rotation (irot), which magick also applies
+		metadata['orientation'] = 0
+	return metadata
+
+def scan_image(original, info_path, web_path, cache=None):
+	# The web copy (with the original's mtime) may not have been made yet (see --pipeline)
+	stat = os.stat(web_path if os.path.exists(web_path) else original)
+	with profile.stage('metadata'):
+		if cache:
+			metadata = cache.get('metadata', info_path, read_metadata,
+				stat if info_path == web_path else None)
+		else:
+			metadata = read_metadata(info_path)
+	return stat, metadata
+
 class ImageInfo(object):
 	images = []
-	def __init__(self, name, spec, dir_spec, original, info_path, web_path, geometry=None):
+	def __init__(self, name, spec, dir_spec, original, info_path, web_path, geometry=None, cache=None,
+		web_conversions=(), scan=None):
 		self.name = name
 		self.original = original
+		self.web_path = web_path
 		self.web_originals, self.web_name = os.path.split(web_path)
+		self.web_conversions = web_conversions
 		self.spec = spec
 		self.dir = dir_spec
 
-		stat = os.stat(web_path)
-		image = Image(info_path)
-		width, height = image.size
+		stat, metadata = scan or scan_image(original, info_path, web_path, cache)
+		width, height = metadata['size']
 
 		self.size_px = f'{width}x{height}'
-		self.size_mb = f'{stat.st_size/1024/1024:.1f}MB'
+		self.set_size_mb(stat)
 
-		if timestamp := image.getTimeCreated() or stat.st_mtime:
+		if timestamp := metadata['time'] or stat.st_mtime:
 			if timestamp > spec.time_adjust_cutoff: timestamp += spec.time_adjust
 			self.time = format_time(timestamp)
 
@@ -97,9 +373,11 @@ class ImageInfo(object):
 
 		check_ar(info_path, 'Image', aspect_ratio, 'spec', spec.aspect_ratio)
 		self.resize_width = self.width
-		self.process_exif(image.exifData)
+		self.camera = metadata['camera']
+		self.camera_info = metadata['camera_info']
+		self.orientation = metadata['orientation']
 		if spec.custom_image_info:
-			spec.custom_image_info(self, image)
+			spec.custom_image_info(self, Image(info_path))
 		self.rotate = spec.rotate.get(os.path.basename(original))
 		if self.rotate in ('-90', '90'):
 			self.width, self.height = self.height, self.width
@@ -107,44 +385,8 @@ class ImageInfo(object):
 		self.geometry = geometry
 		self.images.append(self)
 
-	def process_exif(self, d):
-		self.camera = ''
-		self.camera_info = ''
-		self.orientation = 0
-		if not d: return
-
-		def get_str(key):
-			v = d.get(key)
-			return v.valueType.toStr(v.value) if v else None
-
-		def get_int(key, default=None):
-			v = d.get(key)
-			return v.value[0] if v else default
-
-		self.orientation = get_int(274, 0) # Orientation (short)
-
-		make = get_str(271)
-		model = get_str(272)
-		if not (make and model): return
-		self.camera = model if model.startswith(make) else f'{make} {model}'
-		info = [self.camera]
-		if d := d.get(34665):
-			d = d.value
-			if v := d.get(34855): # PhotographicSensitivity (short)
-				a, = v.value
-				info.append(f'ISO{a}')
-			if v := d.get(41989): # FocalLengthIn35mmFilm (short)
-				a, = v.value
-				info.append(f'{a}mm')
-			if v := d.get(33437): # FNumber (rational)
-				(a, b), = v.value
-				info.append(f'&fnof;{a/b:.2f}'.rstrip('.0'))
-			if v := d.get(42082): # SourceExposureTimesOfCompositeImage
-				info.append(v.toStr(v.value, p=1).split(', ')[1] + 's')
-			elif v := d.get(33434): # ExposureTime (rational)
-				(a, b), = v.value
-				info.append(f'{a}/{b}s')
-		self.camera_info = ', '.join(info)
+	def set_size_mb(self, stat):
+		self.size_mb = f'{stat.st_size/1024/1024:.1f}MB'
 
 	@classmethod
 	def sort(cls):
@@ -155,24 +397,151 @@ class ImageInfo(object):
 		cls.images.sort(key=operator.attrgetter(sort_attr))
 		return cls.images
 
-def read_template(path):
+def template_path(name):
+	# The best album is built in best/, which needn't have its own copy of every template
+	return name if os.path.exists(name) else os.path.join(album_dir, name)
+
+def read_template(path, constants=None):
+	path = template_path(path)
 	with open(path) as file:
 		try:
-			template = temple.parse(file.read())
+			template = temple.parse(file.read(), compile=True, constants=constants,
+				include=lambda name: temple.read_file(template_path(name)), path=path)
 		except temple.TemplateError as error:
 			template = None
 			print(path, error, sep=': ')
 	return template
 
-def create_image_pages(images, options):
-	template = options.image_pages and read_template('page_template.html')
+def render(template, template_vars):
+	with io.StringIO() as output:
+		template.write(output, template_vars)
+		return output.getvalue()
+
+def minify_css(css):
+	css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+	css = re.sub(r'\s+', ' ', css)
+	css = re.sub(r' ?([{}:;,]) ?', r'\1', css)
+	return css.replace(';}', '}').strip() + '\n'
+
+def minify_html(html):
+	# Collapse each run of whitespace to a single newline or space (which the browser
+	# would render the same), and minify the CSS in <style> elements
+	parts = re.split(r'(?<=<style>)(.*?)(?=</style>)', html, flags=re.DOTALL)
+	for i, part in enumerate(parts):
+		if i % 2:
+			parts[i] = minify_css(part)
+		else:
+			parts[i] = re.sub(r'\s+', lambda m: '\n' if '\n' in m.group() else ' ', part)
+	return ''.join(parts)
+
+def get_encoders():
+	encoders = {'.gz': partial(gzip.compress, compresslevel=9, mtime=0)}
+	if brotli:
+		encoders['.br'] = partial(brotli.compress, quality=11)
+	else:
+		print('Not writing .br files (the brotli module is not installed)')
+	return encoders
+
+def write_encoded(path, data, encode):
+	with profile.stage('compress'):
+		data = encode(data)
+	with open(path + '.tmp', 'wb') as file:
+		file.write(data)
+	os.replace(path + '.tmp', path)
+
+class PageWriter(object):
+	# Writes a page only if its content changed, so that unchanged pages keep their mtime.
+	# With precompress, also writes a .gz (and .br) copy of each page, in parallel, unless
+	# the copy is newer than the page.
+	def __init__(self, minify=False, precompress=False, jobs=1):
+		self.written = 0
+		self.unchanged = 0
+		self.minify = minify
+		self.encoders = get_encoders() if precompress else {}
+		self.executor = ThreadPoolExecutor(jobs) if self.encoders else None
+		self.encoding = []
+
+	def write(self, path, template, template_vars):
+		with profile.stage('render'):
+			page = render(template, template_vars)
+		return self.write_page(path, page)
+
+	def write_page(self, path, page):
+		if self.minify:
+			if path.endswith('.html'):
+				page = minify_html(page)
+			elif path.endswith('.css'):
+				page = minify_css(page)
+		if os.path.exists(path):
+			with open(path) as file:
+				changed = file.read() != page
+		else:
+			changed = True
+		if changed:
+			with open(path, 'w') as file:
+				file.write(page)
+			self.written += 1
+		else:
+			self.unchanged += 1
+		self.encode(path, page, changed)
+		return changed
+
+	def encode(self, path, page, changed):
+		mtime = os.stat(path).st_mtime_ns
+		data = None
+		for extension, encode in self.encoders.items():
+			encoded_path = path + extension
+			if not changed and os.path.exists(encoded_path) and os.stat(encoded_path).st_mtime_ns >= mtime:
+				continue
+			data = data or page.encode()
+			self.encoding.append(self.executor.submit(write_encoded, encoded_path, data, encode))
+		if changed and not self.encoders:
+			# Don't leave a stale copy to be served instead of the page
+			for extension in ('.gz', '.br'):
+				if os.path.exists(path + extension):
+					os.remove(path + extension)
+
+	def report(self):
+		if self.written or self.unchanged:
+			print(f'Wrote {self.written} page{"s" if self.written != 1 else ""}'
+				f' ({self.unchanged} unchanged)')
+		if self.executor:
+			for future in self.encoding:
+				future.result()
+			self.executor.shutdown()
+			if self.encoding:
+				print(f'Compressed {len(self.encoding)} file{"s" if len(self.encoding) != 1 else ""}'
+					f' ({", ".join(self.encoders)})')
+
+def remove_old_pages(pattern, current):
+	# Remove the pages (and their .gz and .br copies) matching pattern that weren't
+	# written this time, e.g. the image pages after switching to the viewer
+	for name in os.listdir():
+		if (m := re.fullmatch(f'({pattern})(\\.gz|\\.br)?', name)) and m[1] not in current:
+			os.remove(name)
+
+def image_page_constants(constants):
+	return {**constants, 'index_css': False, 'page_css': True}
+
+def create_image_pages(images, options, writer, constants):
+	constants = image_page_constants(constants)
+	template = options.image_pages and read_template('page_template.html', constants)
+	current = set()
+	for path, template_vars in image_page_vars(images, constants):
+		if template:
+			writer.write(path, template, template_vars)
+			current.add(path)
+	if template:
+		remove_old_pages(r'page\d{3,}\.html|viewer\.html|album(_\d{3,})?\.json', current)
+
+def image_page_vars(images, constants):
 	num_images = len(images)
 
 	for image_number, image in enumerate(images, start=1):
 		image.number = image_number
 		image.page = page_path(image_number)
 		template_vars = {
-			'spec': global_spec,
+			**constants,
 			'image': image,
 			'num_images': num_images,
 			'half_width': image.width // 2,
@@ -195,106 +564,167 @@ def create_image_pages(images, options):
 		else:
 			next_page = 1
 		template_vars['next_page'] = page_path(next_page)
-		if template:
-			with open(image.page, 'w') as file:
-				template.write(file, template_vars)
-
-def fit_sizes1(row_width, sizes):
-	((w, h), images), = sizes
-	new_w = round(row_width / len(images))
-	new_h = round(new_w * h/w)
-	for image in images:
-		image.thumb_width, image.thumb_height = new_w, new_h
-
-def fit_sizes2(row_width, sizes):
-	((w1, h1), images1), ((w2, h2), images2) = sizes
-	n1 = len(images1)
-	n2 = len(images2)
-
-	# (1) n1*(w1+d1) + n2*(w2+d2) = row_width
-	# (2) (w1+d1)*h1/w1 = (w2+d2)*h2/w2
-
-	# w2+d2 = (row_width - n1*(w1+d1)) / n2
-	# w1+d1 = row_width*w1*h2 / (n1*w1*h2 + n2*w2*h1)
-
-	new_w1 = row_width*w1*h2 / (n1*w1*h2 + n2*w2*h1)
-	new_w2 = (row_width - n1*new_w1) / n2
+		yield image.page, template_vars
+
+viewer_shard_size = 1000
+
+def viewer_record(image):
+	record = {
+		'number': image.number,
+		'name': image.name,
+		'web_name': image.web_name,
+		'src': f'{image.dir.images}/{image.web_name}',
+		'original': f'{image.web_originals}/{image.web_name}',
+		'width': image.width,
+		'height': image.height,
+		'srcset': getattr(image, 'srcset', ''),
+		'sizes': getattr(image, 'sizes', ''),
+		'sources': [vars(source) for source in getattr(image, 'sources', ())],
+		'thumb': f'{image.dir.thumbs}/{image.web_name}',
+		'thumb_width': image.thumb_width,
+		'thumb_height': image.thumb_height,
+		'index_page': image.index_page,
+		'caption': image.spec.captions.get(image.name, ''),
+		'time': getattr(image, 'time', ''),
+		'camera': image.camera,
+		'camera_info': image.camera_info,
+		'size_px': image.size_px,
+		'size_mb': image.size_mb,
+	}
+	return {key: value for key, value in record.items() if value or value == 0}
 
-	new_w1 = round(new_w1)
-	new_h1 = round(new_w1 * h1/w1)
-	new_w2 = round(new_w2)
-	new_h2 = round(new_w2 * h2/w2)
+def write_json(writer, path, value):
+	data = json.dumps(value, separators=(',', ':'))
+	writer.write_page(path, data)
+	return path + '?' + hashlib.sha256(data.encode()).hexdigest()[:8]
 
-	for image in images1:
-		image.thumb_width, image.thumb_height = new_w1, new_h1
-	for image in images2:
-		image.thumb_width, image.thumb_height = new_w2, new_h2
+def create_viewer(images, options, writer, constants):
+	"""Write album.json and viewer.html, which shows any image of the album.
 
-def calculate_fitted_sizes(pages):
-	sizemap = defaultdict(list)
-	for page_num, table in enumerate(pages, start=1):
-		max_widths = {}
-		row_width = max(sum(image.thumb_width for image in row) for row in table)
-		last_row = table[-1]
-		for row_num, row in enumerate(table, start=1):
-			for image in row:
-				sizemap[image.thumb_width, image.thumb_height].append(image)
-			sizes = sorted(sizemap.items())
-			if row is last_row and len(row) < global_spec.thumb_cols:
-				row_width = min(row_width, sum(len(images) * max_widths.get(size, size[0])
-					for size, images in sizes))
-			if len(sizes) == 2:
-				fit_sizes2(row_width, sizes)
-			elif len(sizes) == 1:
-				fit_sizes1(row_width, sizes)
-			else:
-				sizes = [f'{w}x{h} [{len(images)}]' for (w, h), images in sizes]
-				sizes = ', '.join(sizes[:-1]) + ', and ' + sizes[-1]
-				print('Cannot calculate fitted sizes for thumbs on '
-					f'page {page_num}, row {row_num}!\n'
-					f'More than two different sizes: {sizes}')
-			for size, images in sizemap.items():
-				w = images[0].thumb_width
-				if w > max_widths.get(size, 0):
-					max_widths[size] = w
-			sizemap.clear()
+	This replaces the page for each image. album.json has a record for each image,
+	unless there are more than viewer_shard_size images, in which case it lists the
+	shards (album_001.json, etc.) that have the records.
+	"""
+	for image_number, image in enumerate(images, start=1):
+		image.number = image_number
+		image.page = f'viewer.html#{image_number}'
+
+	constants = image_page_constants(constants)
+	template = options.image_pages and read_template('viewer_template.html', constants)
+	if not template:
+		return
+
+	records = [viewer_record(image) for image in images]
+	album = {'num_images': len(records)}
+	shards = {}
+	if len(records) > viewer_shard_size:
+		for i in range(0, len(records), viewer_shard_size):
+			path = f'album_{i // viewer_shard_size + 1:03}.json'
+			shards[path] = write_json(writer, path, records[i:i + viewer_shard_size])
+		album['shard_size'] = viewer_shard_size
+		album['shards'] = list(shards.values())
+	else:
+		album['images'] = records
+	write_json(writer, 'album.json', album)
+	writer.write('viewer.html', template, constants)
+	remove_old_pages(r'page\d{3,}\.html|album_\d{3,}\.json', shards)
+
+# The border and margin around each thumb (see .photos img in style_template.css)
+thumb_spacing = 8
+
+def fit_row(row, row_width, row_height=None):
+	# Give the thumbs the same height, and widths that add up to exactly the space
+	# available (or make them row_height high if that's narrower)
+	space = row_width - len(row) * thumb_spacing
+	ratios = [image.thumb_width / image.thumb_height for image in row]
+	if row_height and row_height * sum(ratios) < space:
+		space = round(row_height * sum(ratios))
+
+	exact = [r * space / sum(ratios) for r in ratios]
+	widths = [int(w) for w in exact]
+	by_remainder = sorted(range(len(row)), key=lambda i: widths[i] - exact[i])
+	for i in by_remainder[:space - sum(widths)]:
+		widths[i] += 1
+
+	for image, r, w in zip(row, ratios, widths):
+		image.thumb_width, image.thumb_height = w, round(w / r)
+
+def justify_rows(images, row_width, row_height):
+	# Linear partition: choose the row breaks that minimize the sum over all rows of
+	# (scale - 1)**2, where scale is the factor by which the height of the row must
+	# differ from row_height for the row to be exactly row_width wide. Rows that would
+	# be less than half as high aren't considered, so this takes time proportional to
+	# the number of images times the number of thumbs that fit in a row. The last row
+	# isn't made higher than row_height to fill it.
+	n = len(images)
+	ratios = [image.thumb_width / image.thumb_height for image in images]
+	cost = [0] + [float('inf')] * n
+	row_start = [0] * (n + 1)
+
+	for j in range(1, n + 1):
+		total = 0
+		for i in range(j - 1, -1, -1):
+			total += ratios[i] * row_height
+			space = row_width - (j - i) * thumb_spacing
+			if i < j - 1 and (space <= 0 or total > 2 * space):
+				break
+			scale = space / total
+			c = cost[i] + (0 if j == n and scale >= 1 else (scale - 1)**2)
+			if c < cost[j]:
+				cost[j] = c
+				row_start[j] = i
+
+	rows = []
+	while n:
+		i = row_start[n]
+		rows.append(images[i:n])
+		n = i
+	rows.reverse()
+
+	for row in rows[:-1]:
+		fit_row(row, row_width)
+	if rows:
+		fit_row(rows[-1], row_width, row_height)
+	return rows
 
 def prep_thumb_pages(images, fit):
 	thumb_cols = global_spec.thumb_cols
 	thumb_rows = global_spec.thumb_rows
-	row, table, pages = [], [], []
-	index_page = index_path(1)
 
-	for image in images:
-		image.index_page = index_page
-		row.append(image)
-		if len(row) == thumb_cols:
-			table.append(row)
-			row = []
-			if len(table) == thumb_rows:
-				pages.append(table)
-				table = []
-				index_page = index_path(len(pages) + 1)
-	if row:
-		if not fit:
-			row.extend([None] * (thumb_cols - len(row)))
-		table.append(row)
-	if table:
-		pages.append(table)
 	if fit:
-		calculate_fitted_sizes(pages)
+		rows = justify_rows(images, thumb_cols * (global_spec.thumb_width + thumb_spacing),
+			global_spec.thumb_height)
+	else:
+		rows = [images[i:i + thumb_cols] for i in range(0, len(images), thumb_cols)]
+		if rows and len(rows[-1]) < thumb_cols:
+			rows[-1] = rows[-1] + [None] * (thumb_cols - len(rows[-1]))
+
+	pages = [rows[i:i + thumb_rows] for i in range(0, len(rows), thumb_rows)]
+	for page_num, table in enumerate(pages, start=1):
+		index_page = index_path(page_num)
+		for row in table:
+			for image in row:
+				if image:
+					image.index_page = index_page
 	return pages
 
-def create_thumb_pages(pages, options):
-	fit = options.fit
-	template = options.thumb_pages and read_template('index_template.html')
+def thumb_page_constants(constants):
+	return {**constants, 'index_css': True, 'page_css': False}
+
+def create_thumb_pages(pages, options, writer, constants):
+	constants = thumb_page_constants(constants)
+	template = options.thumb_pages and read_template('index_template.html', constants)
+	for path, template_vars in thumb_page_vars(pages, constants):
+		if template:
+			writer.write(path, template, template_vars)
+
+def thumb_page_vars(pages, constants):
 	num_pages = len(pages)
 
 	for page, table in enumerate(pages, start=1):
 		template_vars = {
-			'spec': global_spec,
+			**constants,
 			'table': table,
-			'fit': fit,
 		}
 		if num_pages > 1:
 			template_vars['number'] = f'{page}/{num_pages}'
@@ -306,27 +736,402 @@ def create_thumb_pages(pages, options):
 				template_vars['next_page'] = index_path(page + 1)
 				if page < num_pages - 1:
 					template_vars['last_page'] = index_path(num_pages)
-		if template:
-			with open(index_path(page), 'w') as file:
-				template.write(file, template_vars)
+		yield index_path(page), template_vars
+
+def create_shared_css(writer, constants):
+	constants = {**constants, 'index_css': True, 'page_css': True}
+	template = read_template('style_template.css', constants)
+	if not template:
+		return None
+	css = render(template, constants)
+	writer.write_page('style.css', css)
+	# The query string changes with the content so that browsers can cache style.css forever
+	return 'style.css?' + hashlib.sha256(css.encode()).hexdigest()[:8]
 
 def mkdir(name):
 	if not os.path.exists(name):
 		os.mkdir(name)
 
-def convert(in_path, out_path, conversions):
-	command = [magick, in_path, *conversions, out_path]
-	print(*command)
-	result = subprocess.run(command)
-	if result.returncode:
-		sys.exit(f'Exit status {result.returncode}')
-	os.chmod(out_path, magick_mode)
+def hash_file(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as file:
+		while b := file.read(1<<20):
+			digest.update(b)
+	return digest.hexdigest()
+
+class Manifest(object):
+	# Records, for each output, the magick arguments it was made with and the
+	# size, mtime, and hash of its source, so that only stale outputs are rebuilt.
+	# Sources are hashed outside the lock, so serve can check and record in parallel.
+	file_name = 'pig_manifest.json'
+
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.entries = {}
+		self.hashes = {}
+		self.skipped = defaultdict(int)
+		self.modified = False
+		self.lock = threading.Lock()
+		if enabled and os.path.exists(self.file_name):
+			with open(self.file_name) as file:
+				self.entries = json.load(file)
+
+	def source_info(self, path):
+		stat = os.stat(path)
+		key = path, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+		if not (digest := self.hashes.get(key)):
+			self.hashes[key] = digest = hash_file(path)
+		return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'ctime_ns': stat.st_ctime_ns,
+			'hash': digest}
+
+	def source_changed(self, source, path):
+		# The ctime changes when a file is patched in place (e.g. by pimly.py -o) even though
+		# its size and mtime don't, and then the hash decides
+		stat = os.stat(path)
+		if (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns) == \
+			(source['size'], source['mtime_ns'], source.get('ctime_ns')):
+			return False
+		info = self.source_info(path)
+		if info['hash'] != source['hash']:
+			return True
+		with self.lock:
+			source.update(info)
+			self.modified = True
+		return False
+
+	def check(self, in_path, out_path, conversions, rebuilt=False):
+		"""Return the reason out_path needs to be (re)built, or None if it doesn't."""
+		if not os.path.exists(out_path):
+			return 'missing'
+		if not self.enabled:
+			return None
+		if rebuilt:
+			return 'source rebuilt'
+		args = [in_path, *conversions, out_path]
+		if not (entry := self.entries.get(out_path)):
+			self.record(args)
+			with self.lock:
+				self.skipped['existing output not yet in ' + self.file_name] += 1
+			return None
+		if entry['args'] != args:
+			return 'recipe changed'
+		if self.source_changed(entry['source'], in_path):
+			return 'source changed'
+		with self.lock:
+			self.skipped['up to date'] += 1
+		return None
+
+	def record(self, args):
+		if self.enabled:
+			source = self.source_info(args[0])
+			with self.lock:
+				self.entries[args[-1]] = {'args': args, 'source': source}
+				self.modified = True
+
+	def remove(self, path):
+		with self.lock:
+			if self.entries.pop(path, None) is not None:
+				self.modified = True
+
+	def save(self):
+		for reason, count in sorted(self.skipped.items()):
+			print(f'Skipped {count} output{"s" if count > 1 else ""} ({reason})')
+		self.skipped.clear()
+		with self.lock:
+			if self.modified:
+				with open(self.file_name + '.tmp', 'w') as file:
+					json.dump(self.entries, file, indent='\t', sort_keys=True)
+				os.replace(self.file_name + '.tmp', self.file_name)
+				self.modified = False
+
+class Conversion(object):
+	def __init__(self, in_path, out_path, conversions, times=None, reason='missing'):
+		self.args = [in_path, *conversions, out_path]
+		self.in_path = in_path
+		self.out_path = out_path
+		self.conversions = conversions
+		self.times = times
+		self.reason = reason
+
+class MagickCommand(object):
+	def __init__(self, conversions):
+		self.conversions = conversions
+		self.result = None
+
+		first, *rest = conversions
+		if not rest:
+			self.command = [magick, *first.args]
+			return
+
+		# Decode the input that the most conversions read (usually the original, even if
+		# the first conversion is a thumb made from its image) only once, and create each of
+		# their outputs from a clone of it. The other conversions read their own input
+		# (e.g. a thumb's image, which may be an output already written).
+		# With -respect-parentheses, settings in one conversion don't leak into the next.
+		outputs = {conversion.out_path for conversion in conversions}
+		inputs = [conversion.in_path for conversion in conversions if conversion.in_path not in outputs]
+		source = max(inputs, key=inputs.count)
+		command = [magick, '-respect-parentheses', source]
+		for conversion in conversions:
+			command.append('(')
+			command.append('+clone' if conversion.in_path == source else conversion.in_path)
+			command.extend(conversion.conversions)
+			command.extend(('-write', conversion.out_path, '+delete', ')'))
+		command.append('null:')
+		self.command = command
+
+	def run(self, capture_output=False):
+		if profile.enabled:
+			self.result = profile.run(self.command, self.conversions, capture_output)
+		else:
+			self.result = subprocess.run(self.command, capture_output=capture_output)
+		if self.result.returncode:
+			return False
+		for conversion in self.conversions:
+			os.chmod(conversion.out_path, magick_mode)
+			if conversion.times:
+				os.utime(conversion.out_path, ns=conversion.times)
+		return True
+
+def run_commands(commands, capture_output=False):
+	# Each command depends on the one before it (e.g. a thumb is made from its image)
+	for command in commands:
+		if not command.run(capture_output):
+			break
+
+def write_output(stream, data):
+	if data:
+		stream.flush()
+		stream.buffer.write(data)
+		stream.buffer.flush()
+
+class ConvertJob(object):
+	def __init__(self, commands, future=None):
+		self.commands = commands
+		self.future = future
+		self.reported = 0
+
+class ConvertPool(object):
+	def __init__(self, jobs, manifest):
+		self.executor = ThreadPoolExecutor(jobs) if jobs > 1 else None
+		self.manifest = manifest
+
+	def submit(self, conversions, pipeline=False):
+		if pipeline and conversions:
+			commands = [MagickCommand(conversions)]
+		else:
+			commands = [MagickCommand([conversion]) for conversion in conversions]
+		if self.executor and commands:
+			return ConvertJob(commands, self.executor.submit(run_commands, commands, True))
+		return ConvertJob(commands)
+
+	def submit_chains(self, chains, originals, pipeline=False):
+		"""Submit each chain of conversions and return a job for each.
+
+		In pipeline mode, all chains for the same original are combined into one magick
+		command, so that the original is decoded only once for all of its outputs.
+		"""
+		if not pipeline:
+			return [self.submit(chain) for chain in chains]
+		groups = defaultdict(list)
+		for chain, original in zip(chains, originals):
+			groups[original].extend(chain)
+		jobs = {original: self.submit(chain, pipeline) for original, chain in groups.items()}
+		return [jobs[original] for original in originals]
+
+	def wait(self, job, last=None):
+		# Called in serial order (optionally only up to and including the command that
+		# makes the conversion "last"), so the output and exit status are the same as
+		# for a serial run. In pipeline mode, though, one command makes the outputs of
+		# every image from the same original (e.g. its crops), so that command is reported
+		# when the first of those images is waited on, ahead of the images in between.
+		commands = job.commands
+		end = len(commands)
+		if last:
+			end = next(i for i, command in enumerate(commands, start=1) if last in command.conversions)
+		if job.future:
+			with profile.stage('convert'):
+				job.future.result()
+		for command in commands[job.reported:end]:
+			for conversion in command.conversions:
+				if conversion.reason != 'missing':
+					print(f'Rebuilding {conversion.out_path} ({conversion.reason})')
+			print(*command.command)
+			if job.future:
+				write_output(sys.stdout, command.result.stdout)
+				write_output(sys.stderr, command.result.stderr)
+			else:
+				with profile.stage('convert'):
+					command.run()
+			if returncode := command.result.returncode:
+				if self.executor:
+					self.executor.shutdown(cancel_futures=True)
+				self.manifest.save()
+				sys.exit(f'Exit status {returncode}')
+			for conversion in command.conversions:
+				self.manifest.record(conversion.args)
+		job.reported = max(job.reported, end)
+
+	def shutdown(self):
+		if self.executor:
+			self.executor.shutdown()
 
 def resize_args(width):
 	return ['-resize', str(width), '-unsharp', '0x0.8+0.8+0.008']
 
+image_types = {
+	'.avif': 'image/avif',
+	'.jpg': 'image/jpeg',
+	'.jxl': 'image/jxl',
+	'.png': 'image/png',
+	'.webp': 'image/webp',
+}
+
+def variant_paths(path, scales, formats):
+	# The scale and path of each other size and format of an image or thumb,
+	# e.g. (0.5, 'images/IMG_0001_0.5x.avif')
+	base, ext = os.path.splitext(path)
+	extensions = [ext, *('.' + f for f in formats if '.' + f.lower() != ext.lower())]
+	for extension in extensions:
+		for scale in scales:
+			if scale != 1 or extension != ext:
+				yield scale, (base if scale == 1 else f'{base}_{scale:g}x') + extension
+
+class Source(object):
+	def __init__(self, extension, srcset):
+		self.type = image_types.get(extension.lower(), 'image/' + extension[1:].lower())
+		self.srcset = srcset
+
+def get_srcsets(path, width, scales, formats):
+	srcsets = defaultdict(list)
+	for scale, variant in [(1, path), *variant_paths(path, scales, formats)]:
+		srcsets[os.path.splitext(variant)[1]].append((round(width * scale), urllib.parse.quote(variant)))
+	srcsets = [(extension, ', '.join(f'{variant} {w}w' for w, variant in sorted(srcset)))
+		for extension, srcset in srcsets.items()]
+	(extension, srcset), *others = srcsets
+	return srcset if len(scales) > 1 else '', [Source(*source) for source in others]
+
+def set_srcsets(image):
+	# For the srcset and sizes attributes of each <img>, and the <source> elements of its <picture>
+	spec = image.spec
+	image.sizes = f'(max-width: {image.width}px) 100vw, {image.width}px'
+	image.srcset, image.sources = get_srcsets(os.path.join(image.dir.images, image.web_name),
+		image.width, spec.image_scales, spec.formats)
+	image.thumb_sizes = f'{image.thumb_width}px'
+	image.thumb_srcset, image.thumb_sources = get_srcsets(os.path.join(image.dir.thumbs, image.web_name),
+		image.thumb_width, spec.thumb_scales, spec.formats)
+
+def image_args(image, normalize_all, scale=1):
+	name = image.name
+	spec = image.spec
+	conversions = []
+	if image.geometry:
+		conversions.append('-crop')
+		conversions.append(image.geometry)
+	if pre_convert := spec.pre_convert.get(name):
+		conversions.extend(pre_convert)
+	conversions.extend(resize_args(round(image.resize_width * scale)))
+	if image.rotate:
+		conversions.append('-rotate')
+		conversions.append(image.rotate)
+	if post_convert := spec.post_convert.get(name):
+		conversions.extend(post_convert)
+	if normalize_all or name in spec.normalize:
+		conversions.append('-normalize')
+	return conversions
+
+sprite_dir = 'sprites'
+sprite_max_height = 8192
+
+def sprite_chunks(table):
+	# Split a page's rows into atlases no higher than sprite_max_height
+	chunk, height = [], 0
+	for row in table:
+		row = [image for image in row if image]
+		row_height = max(image.thumb_height for image in row)
+		if chunk and height + row_height > sprite_max_height:
+			yield chunk
+			chunk, height = [], 0
+		chunk.append(row)
+		height += row_height
+	if chunk:
+		yield chunk
+
+def create_sprites(thumb_pages, pool):
+	"""Pack the thumbs of each index page into one (or a few) atlas images.
+
+	An atlas is named for a hash of its layout and of the size and mtime of its thumbs,
+	so it's only made again when the page's thumbs change.
+	"""
+	mkdir(sprite_dir)
+	# The best album shares its images with the main album, so clear the main album's sprites
+	for table in thumb_pages:
+		for row in table:
+			for image in row:
+				if image:
+					image.sprite = image.sprite_x = image.sprite_y = None
+	conversions = []
+	current = set()
+	for page_num, table in enumerate(thumb_pages, start=1):
+		page_name = os.path.splitext(index_path(page_num))[0]
+		for chunk_num, rows in enumerate(sprite_chunks(table), start=1):
+			if not all(os.path.exists(os.path.join(image.dir.thumbs, image.web_name))
+				for row in rows for image in row):
+				print(f'Not making sprite {chunk_num} for {page_name} (missing thumbs)')
+				continue
+			args, layout = [], []
+			y = 0
+			for row_num, row in enumerate(rows):
+				if row_num:
+					args.append('(')
+				x = 0
+				for image in row:
+					thumb_path = os.path.join(image.dir.thumbs, image.web_name)
+					stat = os.stat(thumb_path)
+					args.append(thumb_path)
+					layout.append((stat.st_size, stat.st_mtime_ns, x, y))
+					image.sprite_x, image.sprite_y = x, y
+					x += image.thumb_width
+				# Thumbs with an Exif orientation are shown rotated by the browser
+				args.append('-auto-orient')
+				args.extend(('-background', 'white', '+append') if not row_num else ('+append', ')'))
+				y += max(image.thumb_height for image in row)
+			args.extend(('-append', '-quality', '90'))
+
+			digest = hashlib.sha256(json.dumps([args, layout]).encode()).hexdigest()
+			sprite_path = os.path.join(sprite_dir, f'{page_name}_{chunk_num}_{digest[:8]}.jpg')
+			current.add(sprite_path)
+			for row in rows:
+				for image in row:
+					image.sprite = sprite_path
+			if not os.path.exists(sprite_path):
+				conversions.append(Conversion(args[0], sprite_path, args[1:]))
+
+	for job in [pool.submit([conversion]) for conversion in conversions]:
+		pool.wait(job)
+	for name in os.listdir(sprite_dir):
+		if (path := os.path.join(sprite_dir, name)) not in current and name.endswith('.jpg'):
+			os.remove(path)
+			pool.manifest.remove(path)
+
+def check_size(path, size, cache):
+	if os.path.exists(path):
+		with profile.stage('size check'):
+			new_size = get_image_size(path, cache)
+		if new_size != size:
+			print('Changing size for {} from {}x{} to {}x{}'.format(path, *size, *new_size))
+			return new_size
+	return size
+
+def apply_orientation(image):
+	if image.orientation > 4:
+		image.width, image.height = image.height, image.width
+		image.thumb_width, image.thumb_height = image.thumb_height, image.thumb_width
+		image.size_px = 'x'.join(image.size_px.split('x')[::-1])
+
 def create_album(images, options):
-	thumb_pages = prep_thumb_pages(images, options.fit)
+	with profile.stage('layout'):
+		thumb_pages = prep_thumb_pages(images, options.fit)
 
 	create_images = options.convert and options.convert_images
 	create_thumbs = options.convert and options.convert_thumbs
@@ -336,52 +1141,213 @@ def create_album(images, options):
 		if create_images: mkdir(spec.images)
 		if create_thumbs: mkdir(spec.thumbs)
 
+	pool = options.pool
+	manifest = pool.manifest
+	chains = []
+	image_conversions = []
 	for image in images:
-		name = image.name
-		spec = image.spec
 		image_path = os.path.join(image.dir.images, image.web_name)
 		thumb_path = os.path.join(image.dir.thumbs, image.web_name)
+		conversions = image_args(image, normalize_all)
+
+		chain = list(image.web_conversions)
+		image_conversion = None
+		if create_images and (reason := manifest.check(image.original, image_path, conversions)):
+			image_conversion = Conversion(image.original, image_path, conversions, reason=reason)
+			chain.append(image_conversion)
+		conversions = resize_args(image.thumb_width)
+		if create_thumbs and (reason := manifest.check(image_path, thumb_path, conversions,
+			rebuilt=image_conversion is not None)):
+			chain.append(Conversion(image_path, thumb_path, conversions, reason=reason))
+		for scale, path in variant_paths(image_path, image.spec.image_scales, image.spec.formats):
+			conversions = image_args(image, normalize_all, scale)
+			if create_images and (reason := manifest.check(image.original, path, conversions)):
+				chain.append(Conversion(image.original, path, conversions, reason=reason))
+		for scale, path in variant_paths(thumb_path, image.spec.thumb_scales, image.spec.formats):
+			conversions = resize_args(round(image.thumb_width * scale))
+			if create_thumbs and (reason := manifest.check(image_path, path, conversions,
+				rebuilt=image_conversion is not None)):
+				chain.append(Conversion(image_path, path, conversions, reason=reason))
+		chains.append(chain)
+		image_conversions.append(image_conversion)
+
+	jobs = pool.submit_chains(chains, [image.original for image in images], options.pipeline)
+
+	for image, job, image_conversion in zip(images, jobs, image_conversions):
+		image_path = os.path.join(image.dir.images, image.web_name)
+		thumb_path = os.path.join(image.dir.thumbs, image.web_name)
+
+		if image_conversion:
+			pool.wait(job, image_conversion)
+		image.width, image.height = check_size(image_path,
+			(image.width, image.height), options.cache)
+
+		pool.wait(job)
+		image.thumb_width, image.thumb_height = check_size(thumb_path,
+			(image.thumb_width, image.thumb_height), options.cache)
+
+		if image.web_conversions:
+			image.set_size_mb(os.stat(image.web_path))
+			# The web copy has been made, so the best album mustn't make it again (in best/)
+			image.web_conversions = ()
+		apply_orientation(image)
+		set_srcsets(image)
+
+	if options.placeholders and options.thumb_pages:
+		with profile.stage('placeholders'):
+			set_placeholders(images, options)
+	if options.sprites and options.thumb_pages:
+		with profile.stage('sprites'):
+			create_sprites(thumb_pages, pool)
+
+	writer = PageWriter(options.minify, options.precompress, options.jobs or os.cpu_count())
+	constants = {'spec': global_spec, 'fit': options.fit, 'sprites': options.sprites,
+		'shared_css': None}
+	if options.shared_css and (options.image_pages or options.thumb_pages):
+		constants['shared_css'] = create_shared_css(writer, constants)
+	if options.viewer:
+		create_viewer(images, options, writer, constants)
+	else:
+		create_image_pages(images, options, writer, constants)
+	create_thumb_pages(thumb_pages, options, writer, constants)
+	with profile.stage('compress (waiting)'):
+		writer.report()
+
+class LazyConversions(object):
+	# Creates each output the first time it's requested. Concurrent requests for the same
+	# output wait for the first one's conversion instead of starting their own.
+	def __init__(self, manifest):
+		self.manifest = manifest
+		self.conversions = {}
+		self.futures = {}
+		self.rebuilt = set()
+		self.lock = threading.Lock()
+
+	def add(self, conversion, depends=None):
+		self.conversions[conversion.out_path] = conversion, depends
+
+	def __contains__(self, path):
+		return path in self.conversions
+
+	def make(self, path):
+		with self.lock:
+			future = self.futures.get(path)
+			if owner := future is None:
+				future = self.futures[path] = Future()
+		if owner:
+			try:
+				ok = self.convert(path)
+			except BaseException as error:
+				ok = error
+			if ok is not True:
+				# Let the next request try again
+				with self.lock:
+					del self.futures[path]
+			if isinstance(ok, BaseException):
+				future.set_exception(ok)
+			else:
+				future.set_result(ok)
+		return future.result()
+
+	def convert(self, path):
+		conversion, depends = self.conversions[path]
+		if depends and not self.make(depends):
+			return False
+		reason = self.manifest.check(conversion.in_path, path, conversion.conversions,
+			rebuilt=depends in self.rebuilt)
+		if not reason:
+			return True
+		command = MagickCommand([conversion])
+		if reason != 'missing':
+			print(f'Rebuilding {path} ({reason})')
+		print(*command.command)
+		if not command.run():
+			print(f'Exit status {command.result.returncode}')
+			return False
+		self.manifest.record(conversion.args)
+		with self.lock:
+			self.rebuilt.add(path)
+		return True
+
+class GalleryHandler(SimpleHTTPRequestHandler):
+	# SimpleHTTPRequestHandler's do_GET and do_HEAD both call send_head
+	def send_head(self):
+		server = self.server
+		path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/') or 'index.html'
+		if page := server.pages.get(path):
+			template, template_vars = page
+			data = render(template, template_vars).encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/html; charset=utf-8')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			return io.BytesIO(data)
+		# Only files in the image directories are served (not e.g. spec.py or pig_cache.json)
+		if os.path.dirname(os.path.normpath(path)) not in server.static_dirs:
+			self.send_error(404)
+			return None
+		if path in server.conversions and not server.conversions.make(path):
+			self.send_error(500, 'Cannot create ' + path)
+			return None
+		return super().send_head()
+
+def serve(images, options):
+	thumb_pages = prep_thumb_pages(images, options.fit)
+	conversions = LazyConversions(options.pool.manifest)
 
-		conversions = []
-		if image.geometry:
-			conversions.append('-crop')
-			conversions.append(image.geometry)
-		if pre_convert := spec.pre_convert.get(name):
-			conversions.extend(pre_convert)
-		conversions.extend(resize_args(image.resize_width))
-		if image.rotate:
-			conversions.append('-rotate')
-			conversions.append(image.rotate)
-		if post_convert := spec.post_convert.get(name):
-			conversions.extend(post_convert)
-		if normalize_all or name in spec.normalize:
-			conversions.append('-normalize')
-
-		if not os.path.exists(image_path) and create_images:
-			convert(image.original, image_path, conversions)
-		if os.path.exists(image_path):
-			size = get_image_size(image_path)
-			if size != (image.width, image.height):
-				print('Changing size for {} from {}x{} to {}x{}'.format(image_path,
-					image.width, image.height, *size))
-				image.width, image.height = size
-
-		if not os.path.exists(thumb_path) and create_thumbs:
-			convert(image_path, thumb_path, resize_args(image.thumb_width))
-		if os.path.exists(thumb_path):
-			size = get_image_size(thumb_path)
-			if size != (image.thumb_width, image.thumb_height):
-				print('Changing size for {} from {}x{} to {}x{}'.format(thumb_path,
-					image.thumb_width, image.thumb_height, *size))
-				image.thumb_width, image.thumb_height = size
-
-		if image.orientation > 4:
-			image.width, image.height = image.height, image.width
-			image.thumb_width, image.thumb_height = image.thumb_height, image.thumb_width
-			image.size_px = 'x'.join(image.size_px.split('x')[::-1])
-
-	create_image_pages(images, options)
-	create_thumb_pages(thumb_pages, options)
+	for spec in {image.dir for image in images}:
+		mkdir(spec.images)
+		mkdir(spec.thumbs)
+
+	for image in images:
+		image_path = os.path.join(image.dir.images, image.web_name)
+		thumb_path = os.path.join(image.dir.thumbs, image.web_name)
+		for conversion in image.web_conversions:
+			conversions.add(conversion)
+		conversions.add(Conversion(image.original, image_path,
+			image_args(image, options.normalize_all)))
+		conversions.add(Conversion(image_path, thumb_path,
+			resize_args(image.thumb_width)), image_path)
+		for scale, path in variant_paths(image_path, image.spec.image_scales, image.spec.formats):
+			conversions.add(Conversion(image.original, path,
+				image_args(image, options.normalize_all, scale)))
+		for scale, path in variant_paths(thumb_path, image.spec.thumb_scales, image.spec.formats):
+			conversions.add(Conversion(image_path, path,
+				resize_args(round(image.thumb_width * scale))), image_path)
+
+		image.width, image.height = check_size(image_path,
+			(image.width, image.height), options.cache)
+		image.thumb_width, image.thumb_height = check_size(thumb_path,
+			(image.thumb_width, image.thumb_height), options.cache)
+		apply_orientation(image)
+		set_srcsets(image)
+	if options.placeholders:
+		# Only for the thumbs that already exist
+		set_placeholders(images, options)
+
+	constants = {'spec': global_spec, 'fit': options.fit, 'sprites': False, 'shared_css': None}
+	pages = {}
+	template = read_template('page_template.html', image_page_constants(constants))
+	for path, template_vars in image_page_vars(images, image_page_constants(constants)):
+		pages[path] = template, template_vars
+	template = read_template('index_template.html', thumb_page_constants(constants))
+	for path, template_vars in thumb_page_vars(thumb_pages, thumb_page_constants(constants)):
+		pages[path] = template, template_vars
+	if not all(template for template, template_vars in pages.values()):
+		sys.exit('Cannot serve without both templates')
+
+	server = ThreadingHTTPServer((options.bind, options.port), GalleryHandler)
+	server.pages = pages
+	server.conversions = conversions
+	server.static_dirs = {sprite_dir, *(name for image in images for name in (image.dir.originals,
+		image.dir.images, image.dir.thumbs, image.web_originals))}
+	print(f'Serving {len(images)} images on http://{options.bind}:{server.server_port}/')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
 
 class DirSpec(object):
 	def __init__(self, suffix):
@@ -403,20 +1369,23 @@ class SharedSpec(object):
 		self.height = d.get('height', global_spec.height)
 		self.thumb_width = d.get('thumb_width', global_spec.thumb_width)
 		self.thumb_height = d.get('thumb_height', global_spec.thumb_height)
+		self.image_scales = sorted({1, *d.get('image_scales', getattr(global_spec, 'image_scales', ()))})
+		self.thumb_scales = sorted({1, *d.get('thumb_scales', getattr(global_spec, 'thumb_scales', ()))})
+		self.formats = d.get('formats', getattr(global_spec, 'formats', ()))
 
 		self.rotate = {name: value for attr, value in (
 			('rotate_left', '-90'),
 			('rotate_right', '90'),
 			('rotate_180', '180')) for name in d.get(attr, ())}
 
-def add_images(d):
+def add_images(d, options):
 	dir_suffix = d.get('dir_suffix', '')
 	dir_spec = DirSpec(dir_suffix)
 	originals = dir_spec.originals
 	spec = SharedSpec(d)
 	skip = frozenset(d.get('skip', ()))
 	ext_map = {
-		'.HEIC': ('.webp','.webp'),
+		'.HEIC': ('.HEIC','.webp'),
 		'.PNG' : ('.webp','.webp'),
 		'.png' : ('.webp','.webp'),
 		'.JPG' : ('.JPG', '.JPG' ),
@@ -425,26 +1394,33 @@ def add_images(d):
 	info_dir = originals + '_info'
 	web_dir = originals + '_web'
 
+	# Each pending entry is (chain, original, finish, scan). The chains are converted and
+	# the scans (the file I/O for each ImageInfo) run concurrently, but each finish (which
+	# prints any messages and makes the ImageInfo) is called in order by scan_images.
+	pending = []
+	def message(*args):
+		pending.append(([], None, partial(print, *args), None))
+
 	spec.aspect_ratio = get_aspect_ratio(spec.width, spec.height)
 	thumb_aspect_ratio = get_aspect_ratio(spec.thumb_width, spec.thumb_height)
-	check_ar(originals, 'Spec', spec.aspect_ratio, 'thumb', thumb_aspect_ratio)
+	pending.append(([], None, partial(check_ar, originals,
+		'Spec', spec.aspect_ratio, 'thumb', thumb_aspect_ratio), None))
 
 	if time_adjust_cutoff := d.get('time_adjust_cutoff', 0):
 		try:
 			time_adjust_cutoff = time.mktime(time.strptime(time_adjust_cutoff, '%Y:%m:%d %H:%M:%S'))
 		except ValueError:
-			print('Cannot parse time_adjust_cutoff for "{}"'.format(originals))
+			message('Cannot parse time_adjust_cutoff for "{}"'.format(originals))
 			time_adjust_cutoff = 0
 	spec.time_adjust_cutoff = time_adjust_cutoff
 
 	def convert_orig(original, conversions, new_paths):
 		stat = os.stat(original)
 		times = stat.st_atime_ns, stat.st_mtime_ns
-		for new_path in new_paths:
-			if not os.path.exists(new_path):
-				convert(original, new_path, conversions)
-				os.utime(new_path, ns=times)
+		return [Conversion(original, new_path, conversions, times, reason) for new_path in new_paths
+			if (reason := manifest.check(original, new_path, conversions))]
 
+	manifest = options.pool.manifest
 	for name in sorted(os.listdir(originals)):
 		if name in skip:
 			continue
@@ -452,7 +1428,7 @@ def add_images(d):
 		basename, extension = os.path.splitext(name)
 		info_ext, web_ext = ext_map.get(extension, (None, None))
 		if not info_ext:
-			print('Skipping', original)
+			message('Skipping', original)
 			continue
 		convert_paths = []
 		if extension == web_ext:
@@ -469,9 +1445,15 @@ def add_images(d):
 			info_path = os.path.join(info_dir, basename + info_ext)
 			convert_paths.append(info_path)
 			mkdir(info_dir)
-		if convert_paths:
-			convert_orig(original, [], convert_paths)
-		ImageInfo(name, spec, dir_spec, original, info_path, web_path)
+		chain = convert_orig(original, [], convert_paths)
+		finish = partial(ImageInfo, name, spec, dir_spec, original, info_path, web_path,
+			cache=options.cache)
+		if options.pipeline and info_path == original:
+			# Not needed for the metadata, so make the web copy with the image and thumb
+			finish = partial(finish, web_conversions=chain)
+			chain = []
+		pending.append((chain, original, finish,
+			partial(scan_image, original, info_path, web_path, options.cache)))
 
 	if crop_list := d.get('crop'):
 		dir_spec = DirSpec(dir_suffix + '_cropped')
@@ -485,10 +1467,12 @@ def add_images(d):
 			basename, extension = os.path.splitext(name)
 			info_ext, web_ext = ext_map.get(extension, (None, None))
 			if not info_ext:
-				print('Skipping', original, '-crop', geometry)
+				message('Skipping', original, '-crop', geometry)
 				continue
 			crop_count_map[name] = crop_count = crop_count_map.get(name, 0) + 1
 			basename = f'{basename}_{crop_count}'
+			if info_ext == extension:
+				info_ext = web_ext # Must get the (cropped) size from the cropped copy
 			crop_name = basename + info_ext
 			web_path = os.path.join(web_dir, basename + web_ext)
 			convert_paths = [web_path]
@@ -498,11 +1482,80 @@ def add_images(d):
 				info_path = os.path.join(info_dir, crop_name)
 				convert_paths.append(info_path)
 				mkdir(info_dir)
-			convert_orig(original, ['-crop', geometry], convert_paths)
-			ImageInfo(crop_name, spec, dir_spec, original, info_path, web_path, geometry=geometry)
+			pending.append((convert_orig(original, ['-crop', geometry], convert_paths), original,
+				partial(ImageInfo, crop_name, spec, dir_spec, original, info_path, web_path,
+					geometry=geometry, cache=options.cache),
+				partial(scan_image, original, info_path, web_path, options.cache)))
+
+	return pending
+
+class ThreadOutput(object):
+	# Stands in for sys.stdout or sys.stderr while scan_images runs, so that what a worker
+	# thread prints can be replayed later in serial order
+	local = threading.local()
+
+	def __init__(self, stream):
+		self.stream = stream
+
+	def write(self, data):
+		if (captured := getattr(self.local, 'captured', None)) is not None:
+			captured.append((self.stream, data))
+			return len(data)
+		return self.stream.write(data)
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+	@classmethod
+	def call(cls, function):
+		cls.local.captured = captured = []
+		try:
+			return function(), captured
+		except Exception as error:
+			return error, captured
+		finally:
+			cls.local.captured = None
+
+def scan_images(pending, options):
+	start = time.perf_counter()
+	pool = options.pool
+	jobs = options.scan_jobs or os.cpu_count()
+	executor = ThreadPoolExecutor(jobs) if jobs > 1 else None
+
+	chains, originals, finishers, scans = zip(*pending) if pending else ((), (), (), ())
+	if executor:
+		sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+	try:
+		futures = [executor.submit(ThreadOutput.call, scan)
+			# An output of the chain may be read, so scan only after it's been converted
+			if executor and scan and not chain else None
+			for chain, scan in zip(chains, scans)]
+		convert_jobs = pool.submit_chains(chains, originals, options.pipeline)
+		for job, finish, scan, future in zip(convert_jobs, finishers, scans, futures):
+			pool.wait(job)
+			if future:
+				result, captured = future.result()
+				for stream, data in captured:
+					stream.write(data)
+				if isinstance(result, Exception):
+					raise result
+				finish(scan=result)
+			elif scan:
+				finish(scan=scan())
+			else:
+				finish()
+	finally:
+		if executor:
+			sys.stdout, sys.stderr = sys.stdout.stream, sys.stderr.stream
+			executor.shutdown(cancel_futures=True)
+
+	if num_scanned := sum(1 for scan in scans if scan):
+		print(f'Scanned {num_scanned} image{"s" if num_scanned != 1 else ""}'
+			f' in {time.perf_counter() - start:.2f}s ({jobs} worker{"s" if jobs != 1 else ""})')
 
 def get_options():
 	parser = argparse.ArgumentParser(allow_abbrev=False)
+	parser.add_argument('command', nargs='?', choices=('build', 'serve'), default='build')
 	parser.add_argument('--no-convert', dest='convert', action='store_false')
 	parser.add_argument('--no-convert-images', dest='convert_images', action='store_false')
 	parser.add_argument('--no-convert-thumbs', dest='convert_thumbs', action='store_false')
@@ -511,23 +1564,66 @@ def get_options():
 	parser.add_argument('--no-thumb-pages', dest='thumb_pages', action='store_false')
 	parser.add_argument('--no-best', dest='best', action='store_false')
 	parser.add_argument('--fit', action='store_true')
+	parser.add_argument('--shared-css', action='store_true')
+	parser.add_argument('--minify', action='store_true')
+	parser.add_argument('--precompress', action='store_true')
+	parser.add_argument('--viewer', action='store_true')
+	parser.add_argument('--no-placeholders', dest='placeholders', action='store_false')
+	parser.add_argument('--sprites', action='store_true')
+	parser.add_argument('-j', '--jobs', type=int, default=1)
+	parser.add_argument('--scan-jobs', type=int, default=8)
+	parser.add_argument('--no-manifest', dest='manifest', action='store_false')
+	parser.add_argument('--pipeline', action='store_true')
+	parser.add_argument('--no-cache', dest='cache', action='store_false')
+	parser.add_argument('--verify-cache', action='store_true')
+	parser.add_argument('--rebuild-cache', action='store_true')
+	parser.add_argument('--profile', type=int, nargs='?', const=10)
+	parser.add_argument('--bind', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8000)
 	return parser.parse_args()
 
 def main():
 	options = get_options()
-
-	add_images(vars(global_spec))
-	for spec in getattr(global_spec, 'more_photos', ()):
-		add_images(spec)
+	if options.command == 'serve':
+		# Leave the web copies of originals to be made on demand too
+		options.pipeline = True
+	options.pool = ConvertPool(options.jobs or os.cpu_count(), Manifest(options.manifest))
+	options.cache = MetadataCache(options.cache, options.verify_cache, options.rebuild_cache)
+
+	profile.enabled = options.profile is not None
+	with profile.stage('add images'):
+		pending = add_images(vars(global_spec), options)
+		for spec in getattr(global_spec, 'more_photos', ()):
+			pending.extend(add_images(spec, options))
+	with profile.stage('scan'):
+		scan_images(pending, options)
 
 	images = ImageInfo.sort()
+	if options.command == 'serve':
+		serve(images, options)
+		options.pool.manifest.save()
+		options.cache.save()
+		options.pool.shutdown()
+		return
+
 	create_album(images, options)
+	options.pool.manifest.save()
 
 	if options.best and os.path.exists('best'):
 		images = [image for image in images if image.name in image.spec.best]
 		os.chdir('best')
+		options.pool.manifest = Manifest(options.manifest)
 		create_album(images, options)
+		options.pool.manifest.save()
 		os.chdir('..')
 
+	options.cache.save()
+	options.pool.shutdown()
+	if identify_count:
+		print(f'Ran {identify[-1]} {identify_count} time{"s" if identify_count > 1 else ""}'
+			' (pimly could not read the image size)')
+	if profile.enabled:
+		profile.report(options.profile)
+
 if __name__ == '__main__':
 	main()
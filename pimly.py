@@ -1,21 +1,32 @@
 #
 # pimly.py (Pius' Image Library)
 #
+from collections import deque
+import contextlib
+from functools import partial
+import io
+import json
 import os
 import re
+import struct
 import sys
 import time
 
 __all__ = ('Image',)
 
+# Each parse passes the byte order (BigEndian or LittleEndian) along instead of
+# keeping it in a global, so images can be parsed concurrently.
+
 class BigEndian(object):
 	name = 'Big Endian'
+	format = '>'
+	ifdEntries = struct.Struct('>HHII').iter_unpack
 	@staticmethod
-	def int4(b, i=0):
-		return b[i+3] + (b[i+2]<<8) + (b[i+1]<<16) + (b[i]<<24)
+	def int4(b, i=0, unpack=struct.Struct('>I').unpack_from):
+		return unpack(b, i)[0]
 	@staticmethod
-	def int2(b, i=0):
-		return b[i+1] + (b[i]<<8)
+	def int2(b, i=0, unpack=struct.Struct('>H').unpack_from):
+		return unpack(b, i)[0]
 	@staticmethod
 	def str4(n):
 		return ''.join((chr((n>>24)&255), chr((n>>16)&255), chr((n>>8)&255), chr(n&255)))
@@ -25,15 +36,17 @@ class BigEndian(object):
 
 class LittleEndian(object):
 	name = 'Little Endian'
+	format = '<'
+	ifdEntries = struct.Struct('<HHII').iter_unpack
 	@staticmethod
-	def int4(b, i=0):
-		return b[i] + (b[i+1]<<8) + (b[i+2]<<16) + (b[i+3]<<24)
+	def int4(b, i=0, unpack=struct.Struct('<I').unpack_from):
+		return unpack(b, i)[0]
 	@staticmethod
 	def int3(b, i=0):
 		return b[i] + (b[i+1]<<8) + (b[i+2]<<16)
 	@staticmethod
-	def int2(b, i=0):
-		return b[i] + (b[i+1]<<8)
+	def int2(b, i=0, unpack=struct.Struct('<H').unpack_from):
+		return unpack(b, i)[0]
 	@staticmethod
 	def str4(n):
 		return ''.join((chr(n&255), chr((n>>8)&255), chr((n>>16)&255), chr((n>>24)&255)))
@@ -41,12 +54,6 @@ class LittleEndian(object):
 	def str2(n):
 		return ''.join((chr(n&255), chr((n>>8)&255)))
 
-E = LittleEndian
-
-# Convert 32-bit unsigned integer to 32-bit signed integer
-def sInt4(n):
-	return n - (1 << 32) if (n >> 31) == 1 else n
-
 def escapeString(s):
 	if isinstance(s, str):
 		s = s.encode()
@@ -98,32 +105,34 @@ def pngReadHeader(image, b, f):
 # DCF Spec: http://www.cipa.jp/std/documents/e/DC-009-2010_E.pdf
 # IFD = Image File Directory
 
-def exifReadByte(b, offset, count):
+def exifReadByte(E, b, offset, count):
 	return [b[i] for i in range(offset, offset + count)]
 
-def exifReadAscii(b, offset, count):
+def exifReadAscii(E, b, offset, count):
 	value = b[offset : offset + count]
 	if value[-1] != 0:
 		print('ASCII value not terminated with NULL:', escapeString(value), file=sys.stderr)
 	return value.rstrip(b'\x00\t\n\r ').decode()
 
-def exifReadShort(b, offset, count):
-	return [E.int2(b, i) for i in range(offset, offset + count*2, 2)]
+def exifReadShort(E, b, offset, count):
+	return list(struct.unpack_from(f'{E.format}{count}H', b, offset))
 
-def exifReadLong(b, offset, count):
-	return [E.int4(b, i) for i in range(offset, offset + count*4, 4)]
+def exifReadLong(E, b, offset, count):
+	return list(struct.unpack_from(f'{E.format}{count}I', b, offset))
 
-def exifReadRational(b, offset, count):
-	return [(E.int4(b, i), E.int4(b, i+4)) for i in range(offset, offset + count*8, 8)]
+def exifReadRational(E, b, offset, count):
+	values = struct.unpack_from(f'{E.format}{count*2}I', b, offset)
+	return list(zip(values[0::2], values[1::2]))
 
-def exifReadUndefined(b, offset, count):
+def exifReadUndefined(E, b, offset, count):
 	return b[offset : offset + count]
 
-def exifReadSignedLong(b, offset, count):
-	return [sInt4(E.int4(b, i)) for i in range(offset, offset + count*4, 4)]
+def exifReadSignedLong(E, b, offset, count):
+	return list(struct.unpack_from(f'{E.format}{count}i', b, offset))
 
-def exifReadSignedRational(b, offset, count):
-	return [(sInt4(E.int4(b, i)), sInt4(E.int4(b, i+4))) for i in range(offset, offset + count*8, 8)]
+def exifReadSignedRational(E, b, offset, count):
+	values = struct.unpack_from(f'{E.format}{count*2}i', b, offset)
+	return list(zip(values[0::2], values[1::2]))
 
 def toStrUnknown(value):
 	return f'[Unrecognized type {value}]'
@@ -160,17 +169,32 @@ ExifTypeSignedLong     = ExifType( 9, exifReadSignedLong,     toStrInteger,   4)
 ExifTypeSignedRational = ExifType(10, exifReadSignedRational, toStrRational,  2*ExifTypeSignedLong.size)
 
 class ExifTagInfo(object):
-	def __init__(self, name, subIFD=None, toStr=None):
+	def __init__(self, name, subIFD=None, toStr=None, toStrByteOrder=False):
 		self.name = name
 		self.subIFD = subIFD
 		self.toStr = toStr
+		self.toStrByteOrder = toStrByteOrder # Whether toStr needs the byte order (E=...)
 
 class ExifTagData(object):
-	def __init__(self, info):
+	# Only the directory entry and the value's bytes are kept when the IFD is parsed. The
+	# value is decoded when it's first accessed, so tags that are never used cost very little.
+	__slots__ = ('name', 'toStr', 'valueType', 'count', 'offset', 'data', 'byteOrder', '_value')
+
+	def __init__(self, info, E, valueType=None, value=None):
 		self.name = info.name
-		self.toStr = info.toStr
-		self.valueType = None
-		self.value = None
+		self.toStr = partial(info.toStr, E=E) if info.toStrByteOrder else info.toStr
+		self.byteOrder = E
+		self.valueType = valueType
+		self.data = None
+		self._value = value
+
+	@property
+	def value(self):
+		# Threads can share an Image, so the value is set before data is cleared
+		if (data := self.data) is not None:
+			self._value = self.valueType.read(self.byteOrder, data, 0, self.count)
+			self.data = None
+		return self._value
 
 	def sortkey(self):
 		return format(self.name, '05') if isinstance(self.name, int) else self.name
@@ -189,8 +213,7 @@ def toStrMakerNote(value):
 
 	if value.startswith(b'Apple iOS\x00'):
 		assert value[12:14] == b'MM'
-		assert E is BigEndian
-		assert E.int2(value, 10) == 1
+		assert BigEndian.int2(value, 10) == 1
 
 #		print('Apple iOS', end='')
 #		return exifReadIFD(value, 14, appleIFD)
@@ -210,10 +233,10 @@ def toStrAltitude(value):
 	(n, d), = value
 	return f'{n}/{d} ({n/d:.1f} meters)'
 
-def toStrCompositeExposureTimes(value, p=3):
+def toStrCompositeExposureTimes(value, p=3, E=BigEndian):
 	assert len(value) == 58
-	values = [f'{n/d:.{p}f}'.rstrip('.0') or '0' for n, d in exifReadRational(value, 0, 7)]
-	m, = exifReadShort(value, 7*8, 1)
+	values = [f'{n/d:.{p}f}'.rstrip('.0') or '0' for n, d in exifReadRational(E, value, 0, 7)]
+	m, = exifReadShort(E, value, 7*8, 1)
 	assert m == 0
 	values.append(str(m))
 	return ', '.join(values)
@@ -304,7 +327,8 @@ exifIFD0 = ExifTagInfo('IFD0', subIFD={
 		42037: ExifTagInfo('LensSerialNumber'),
 		42080: ExifTagInfo('CompositeImage'),
 		42081: ExifTagInfo('SourceImageNumberOfCompositeImage'),
-		42082: ExifTagInfo('SourceExposureTimesOfCompositeImage', toStr=toStrCompositeExposureTimes),
+		42082: ExifTagInfo('SourceExposureTimesOfCompositeImage', toStr=toStrCompositeExposureTimes,
+			toStrByteOrder=True),
 	}),
 	34853: ExifTagInfo('GPS IFD', subIFD={
 		0: ExifTagInfo('GPSVersionID', toStr=lambda v: '.'.join([str(i) for i in v])),
@@ -386,51 +410,52 @@ badExifOffset = {
 	(b'2010:07:24 14:25:56', 194): 12, # IMG_0318.JPG
 }
 
-def exifReadIFD(b, i, ifdInfo):
+def exifReadIFD(E, b, i, ifdInfo, onlyKnown=False):
 	ifdData = {}
 
 	n = E.int2(b, i) # Number of fields
-	i += 2
-
-	while n > 0:
-		tag = E.int2(b, i)
-		valueType = E.int2(b, i+2)
-		typeInfo = ExifType.lookup.get(valueType)
-
-		count = E.int4(b, i+4)
-		i += 8
+	i += 2 - 12
 
+	for tag, valueType, count, offset in E.ifdEntries(b[i + 12 : i + 12 + 12*n]):
+		i += 12
 		if not (tagInfo := ifdInfo.get(tag)):
-			ifdInfo[tag] = tagInfo = ExifTagInfo(tag)
-		ifdData[tag] = tagData = ExifTagData(tagInfo)
+			if onlyKnown:
+				continue
+			tagInfo = ExifTagInfo(tag)
+		typeInfo = ExifType.lookup.get(valueType)
 
 		if not typeInfo:
-			tagData.valueType = ExifTypeUnknown
-			tagData.value = valueType
+			ifdData[tag] = ExifTagData(tagInfo, E, ExifTypeUnknown, valueType)
 		elif not tagInfo.subIFD:
-			tagData.valueType = typeInfo
-			tagData.offset = offset = E.int4(b, i) if typeInfo.size * count > 4 else i
-			tagData.value = typeInfo.read(b, offset, count)
+			ifdData[tag] = tagData = ExifTagData(tagInfo, E, typeInfo)
+			size = typeInfo.size * count
+			tagData.offset = offset if size > 4 else i + 8
 			tagData.count = count
+			# Just the value's bytes, so the rest of the Exif data (e.g. the IFD1 thumbnail) isn't kept
+			tagData.data = bytes(b[tagData.offset : tagData.offset + size])
 		else:
 			assert valueType == 4
 			assert count == 1
-			offset = E.int4(b, i)
 
 			if tag == 34665:
 				dateTime = ifdData.get(306)
 				if dateTime is not None:
 					offset += badExifOffset.get((dateTime.value, offset), 0)
 
-			tagData.value = exifReadIFD(b, offset, tagInfo.subIFD)
-		i += 4
-		n -= 1
+			ifdData[tag] = ExifTagData(tagInfo, E,
+				value=exifReadIFD(E, b, offset, tagInfo.subIFD, onlyKnown))
 
 	return ifdData
 
-def exifRead(b):
-	global E
+# Just the tags that Image.getTimeCreated needs (DateTime is for badExifOffset)
+exifTimeIFD0 = ExifTagInfo('IFD0', subIFD={
+	306: exifIFD0.subIFD[306],
+	34665: ExifTagInfo('Exif IFD', subIFD={
+		36867: exifIFD0.subIFD[34665].subIFD[36867],
+	}),
+})
 
+def exifRead(b, timeOnly=False):
 	if b[0:2] == b'II':
 		E = LittleEndian
 	else:
@@ -441,7 +466,9 @@ def exifRead(b):
 
 	ifd0_offset = E.int4(b, 4)
 
-	return exifReadIFD(b, ifd0_offset, exifIFD0.subIFD)
+	if timeOnly:
+		return E, exifReadIFD(E, b, ifd0_offset, exifTimeIFD0.subIFD, True)
+	return E, exifReadIFD(E, b, ifd0_offset, exifIFD0.subIFD)
 
 # JPEG Spec: https://www.w3.org/Graphics/JPEG/itu-t81.pdf
 
@@ -490,8 +517,9 @@ def jpegReadSegments(image, f):
 			else:
 				jpegType = 'Exif'
 				image.exifOffset = pos + 6
-				image.exifData = exifRead(b[6:])
-				image.byteOrder = E
+				image.byteOrder, image.exifData = exifRead(b[6:], image.timeOnly)
+				if image.timeOnly:
+					break
 		elif marker == 0xE0:
 			b = f.read(segmentLength)
 			if b[:5] != b'JFIF\x00':
@@ -514,6 +542,11 @@ def webpReadHeader(image, hdr, f):
 		int2 = LittleEndian.int2
 		assert b[7:10] == b'\x9d\x01\x2a'
 		image.size = int2(b, 10) & 0x3fff, int2(b, 12) & 0x3fff
+	elif hdr == b'VP8L':
+		# https://www.rfc-editor.org/rfc/rfc9649.html#section-3.2
+		assert b[4] == 0x2f
+		bits = LittleEndian.int4(b, 5)
+		image.size = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
 	elif hdr == b'VP8X':
 		# https://www.rfc-editor.org/rfc/rfc9649.html#section-2.7
 		int4 = LittleEndian.int4
@@ -522,39 +555,248 @@ def webpReadHeader(image, hdr, f):
 		image.size = int3(b, 8) + 1, int3(b, 11) + 1
 
 		while len(b := f.read(8)) == 8:
+			chunkType = b[:4]
 			size = int4(b, 4)
-			if b[:4] == b'EXIF':
+			if chunkType == b'EXIF':
 				image.exifOffset = f.tell()
-				image.exifData = exifRead(f.read(size))
-				image.byteOrder = E
-			elif b[:4] == b'XMP ':
+				b = f.read(size)
+				if b[:6] == b'Exif\x00\x00':
+					image.exifOffset += 6
+					b = b[6:]
+				image.byteOrder, image.exifData = exifRead(b, image.timeOnly)
+				if image.timeOnly:
+					return
+			elif chunkType == b'XMP ':
 				image.xmpData = f.read(size).decode()
+			elif chunkType == b'ANIM':
+				b = f.read(size)
+				image.loopCount = LittleEndian.int2(b, 4)
+				image.frames = 0
+			elif chunkType == b'ANMF':
+				image.frames = getattr(image, 'frames', 0) + 1
+				f.seek(size, 1)
 			else:
 				f.seek(size, 1)
+			if size & 1:
+				f.seek(1, 1) # Chunks are padded to an even size
 		assert b.strip(b'\x00') == b''
 
+# HEIF Spec: ISO/IEC 23008-12 (based on the ISO Base Media File Format, ISO/IEC 14496-12)
+
+heifBrands = (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1', b'avif', b'avis')
+
+def heifInt(b, i, n):
+	return int.from_bytes(b[i:i+n], 'big')
+
+def heifBoxes(b, i, end):
+	int4 = BigEndian.int4
+	while i + 8 <= end:
+		size = int4(b, i)
+		boxType = b[i+4:i+8]
+		header = 8
+		if size == 1:
+			size = heifInt(b, i+8, 8)
+			header = 16
+		elif size == 0:
+			size = end - i
+		yield boxType, i + header, i + size
+		i += size
+
+def heifReadItemInfo(b, i, end, items):
+	version = b[i]
+	i += 6 if version == 0 else 8
+	for boxType, j, boxEnd in heifBoxes(b, i, end):
+		if boxType != b'infe' or b[j] < 2:
+			continue
+		if b[j] == 2:
+			itemID = BigEndian.int2(b, j+4)
+			j += 6
+		else:
+			itemID = BigEndian.int4(b, j+4)
+			j += 8
+		itemType = b[j+2:j+6]
+		if itemType == b'mime':
+			# item_name and content_type are null-terminated strings
+			name, contentType, *rest = b[j+6:boxEnd].split(b'\x00')
+			itemType = contentType
+		items[itemID] = itemType
+
+def heifReadItemLocations(b, i, locations):
+	int2 = BigEndian.int2
+	int4 = BigEndian.int4
+	version = b[i]
+	offsetSize, lengthSize = b[i+4] >> 4, b[i+4] & 15
+	baseOffsetSize, indexSize = b[i+5] >> 4, b[i+5] & 15 if version else 0
+	if version < 2:
+		count = int2(b, i+6)
+		i += 8
+	else:
+		count = int4(b, i+6)
+		i += 10
+	while count > 0:
+		if version < 2:
+			itemID = int2(b, i)
+			i += 2
+		else:
+			itemID = int4(b, i)
+			i += 4
+		method = 0
+		if version:
+			method = int2(b, i) & 15
+			i += 2
+		i += 2 # data_reference_index
+		baseOffset = heifInt(b, i, baseOffsetSize)
+		i += baseOffsetSize
+		extentCount = int2(b, i)
+		i += 2
+		extents = []
+		while extentCount > 0:
+			i += indexSize
+			offset = heifInt(b, i, offsetSize)
+			i += offsetSize
+			length = heifInt(b, i, lengthSize)
+			i += lengthSize
+			extents.append((baseOffset + offset, length))
+			extentCount -= 1
+		locations[itemID] = method, extents
+		count -= 1
+
+def heifReadItemProperties(b, i, end, properties, associations):
+	for boxType, j, boxEnd in heifBoxes(b, i, end):
+		if boxType == b'ipco':
+			properties.extend(heifBoxes(b, j, boxEnd))
+		elif boxType == b'ipma':
+			version = b[j]
+			largeIndex = b[j+3] & 1
+			count = BigEndian.int4(b, j+4)
+			j += 8
+			while count > 0:
+				if version < 1:
+					itemID = BigEndian.int2(b, j)
+					j += 2
+				else:
+					itemID = BigEndian.int4(b, j)
+					j += 4
+				indexes = associations[itemID] = []
+				n = b[j]
+				j += 1
+				while n > 0:
+					if largeIndex:
+						indexes.append(BigEndian.int2(b, j) & 0x7fff)
+						j += 2
+					else:
+						indexes.append(b[j] & 0x7f)
+						j += 1
+					n -= 1
+				count -= 1
+
+def heifReadItem(f, location):
+	method, extents = location
+	if method != 0: # Only file offsets (not idat or item offsets) are supported
+		return (), b''
+	data = []
+	for offset, length in extents:
+		f.seek(offset)
+		data.append(f.read(length))
+	return extents, b''.join(data)
+
+def heifReadMeta(image, b, f):
+	items = {}
+	locations = {}
+	properties = []
+	associations = {}
+	primary = None
+
+	for boxType, i, end in heifBoxes(b, 4, len(b)):
+		if boxType == b'pitm':
+			primary = BigEndian.int2(b, i+4) if b[i] == 0 else BigEndian.int4(b, i+4)
+		elif boxType == b'iinf':
+			heifReadItemInfo(b, i, end, items)
+		elif boxType == b'iloc':
+			heifReadItemLocations(b, i, locations)
+		elif boxType == b'iprp':
+			heifReadItemProperties(b, i, end, properties, associations)
+
+	size = None
+	rotation = 0
+	for index in associations.get(primary, ()):
+		if not 0 < index <= len(properties):
+			continue
+		boxType, i, end = properties[index - 1]
+		if boxType == b'ispe':
+			size = BigEndian.int4(b, i+4), BigEndian.int4(b, i+8)
+		elif boxType == b'irot':
+			rotation = b[i] & 3
+	if size and rotation & 1:
+		size = size[1], size[0]
+	image.size = size
+
+	for itemID, itemType in sorted(items.items()):
+		if itemID not in locations:
+			continue
+		if itemType == b'Exif' and not image.exifData:
+			extents, data = heifReadItem(f, locations[itemID])
+			if len(data) < 4:
+				continue
+			# The Exif item starts with the offset to the TIFF header (usually after "Exif\0\0")
+			i = 4 + BigEndian.int4(data)
+			# Values can only be patched in place if the item is stored in one extent
+			image.exifOffset = extents[0][0] + i if len(extents) == 1 else None
+			image.byteOrder, image.exifData = exifRead(data[i:], image.timeOnly)
+		elif itemType == b'application/rdf+xml' and not image.xmpData:
+			extents, data = heifReadItem(f, locations[itemID])
+			image.xmpData = data.decode()
+
+def heifReadHeader(image, f):
+	f.seek(0)
+	while len(b := f.read(8)) == 8:
+		size = BigEndian.int4(b)
+		boxType = b[4:8]
+		header = 8
+		if size == 1:
+			size = heifInt(f.read(8), 0, 8)
+			header = 16
+		if boxType == b'meta':
+			heifReadMeta(image, f.read(size - header), f)
+			break
+		if size == 0:
+			break
+		f.seek(size - header, 1)
+
 class Image(object):
 	xmpEndOfLine = re.compile(' *\\n *')
 	xmpDateCreated = re.compile('<{0}>({1}-{2}-{2}T{2}:{2}:{2})</{0}>'.format(
 		'photoshop:DateCreated', '\\d{4}', '\\d{2}'))
 
-	def __init__(self, filename):
+	def __init__(self, filename, timeOnly=False):
+		# With timeOnly, only what getTimeCreated needs is read, and reading stops
+		# as soon as the Exif data is found
 		self.fileName = filename
+		self.timeOnly = timeOnly
+		self.format = None
 		self.size = None
 		self.exifData = None
+		self.exifOffset = None
 		self.xmpData = None
 
 		with open(filename, 'rb') as f:
 			b = f.read(16)
 			if b[:2] == b'\xFF\xD8':
+				self.format = 'JPEG'
 				jpegReadSegments(self, f)
 
 			elif b[:8] == b'\x89PNG\r\n\x1A\n':
+				self.format = 'PNG'
 				pngReadHeader(self, b[8:], f)
 
 			elif b[:4] == b'RIFF' and b[8:12] == b'WEBP':
+				self.format = 'WebP'
 				webpReadHeader(self, b[12:16], f)
 
+			elif b[4:8] == b'ftyp' and b[8:12] in heifBrands:
+				self.format = 'HEIF'
+				heifReadHeader(self, f)
+
 	def getTimeCreatedXmp(self):
 		if not self.xmpData:
 			return 0
@@ -601,73 +843,242 @@ class Image(object):
 			print('\nFileName', self.fileName, sep=': ')
 			print(self.xmpData)
 
-def setOrientation(image, args):
+def findExifTag(ifdData, name):
+	for tagData in ifdData.values():
+		if tagData.name == name:
+			return tagData
+		if isinstance(tagData.value, dict) and (found := findExifTag(tagData.value, name)):
+			return found
+	return None
+
+exifStructFormats = {
+	ExifTypeByte: 'B',
+	ExifTypeShort: 'H',
+	ExifTypeLong: 'I',
+	ExifTypeRational: 'I',
+	ExifTypeSignedLong: 'i',
+	ExifTypeSignedRational: 'i',
+}
+
+def exifEncode(tagData, text):
+	# Returns text encoded as the tag's type in the image's byte order. Since the value is
+	# overwritten in place, it must have the same size as the tag's current value.
+	valueType = tagData.valueType
+	structFormat = exifStructFormats.get(valueType)
+	if not structFormat and valueType is not ExifTypeAscii:
+		raise ValueError('has a type that cannot be set')
+	count = tagData.count
+	if valueType is ExifTypeAscii:
+		value = text.encode() + b'\x00'
+		if len(value) != count:
+			raise ValueError(f'must be {count - 1} characters long')
+		return value
+	try:
+		if valueType in (ExifTypeRational, ExifTypeSignedRational):
+			numbers = [int(n) for v in text.split() for n in v.split('/', 1)]
+			if len(numbers) != count * 2:
+				raise ValueError(f'must be {count} rational number(s) like 72/1')
+		else:
+			numbers = [int(v) for v in text.split()]
+			if len(numbers) != count:
+				raise ValueError(f'must be {count} integer(s)')
+		return struct.pack(f'{tagData.byteOrder.format}{len(numbers)}{structFormat}', *numbers)
+	except struct.error as e:
+		raise ValueError(str(e))
+
+def reflinkCopy(fileName, newFileName):
+	# Shares the file's data blocks where the file system supports it (FICLONE on Linux),
+	# so only the blocks that are patched later get copied
+	import shutil
+	with open(fileName, 'rb') as oldFile, open(newFileName, 'xb') as newFile:
+		try:
+			import fcntl
+			fcntl.ioctl(newFile.fileno(), 0x40049409, oldFile.fileno()) # FICLONE
+		except (ImportError, OSError):
+			shutil.copyfileobj(oldFile, newFile, 1<<20)
+	shutil.copymode(fileName, newFileName)
+
+def setExifValues(image, args):
 	if image.exifData is None:
 		print(image.fileName, 'doesn\'t have Exif metadata')
 		return
-
-	tagData = image.exifData.get(274)
-	if tagData is None:
-		print(image.fileName, 'doesn\'t have an Orientation tag')
+	if image.exifOffset is None:
+		print(image.fileName, 'has its Exif metadata in more than one piece (can\'t patch it in place)')
 		return
 
-	assert tagData.valueType is ExifTypeShort
-	assert tagData.count == 1
-
-	newValue = args.orientation
-
-	if tagData.value[0] == newValue:
-		print(image.fileName, 'already has Orientation', newValue)
-		return
-
-	if not image.fileName.endswith(('.JPG', '.jpg', '.JPEG', '.jpeg')):
-		print(image.fileName, 'must end with .JPG, .jpg, .JPEG, or .jpeg')
-		return
+	patches = []
+	for name, text in args.exifValues:
+		tagData = findExifTag(image.exifData, name)
+		if tagData is None or tagData.valueType is None:
+			print(image.fileName, 'doesn\'t have a', name, 'tag')
+			return
+		try:
+			value = exifEncode(tagData, text)
+		except ValueError as e:
+			print(image.fileName, name, e)
+			return
+		patches.append((name, image.exifOffset + tagData.offset, value))
 
-	fileName, suffix = image.fileName.rsplit('.', 1)
-	fileName = '.'.join((fileName, 'new', suffix))
+	fileInfo = os.stat(image.fileName)
+	fd = os.open(image.fileName, os.O_RDONLY)
+	try:
+		patches = [patch for patch in patches if os.pread(fd, len(patch[2]), patch[1]) != patch[2]]
+	finally:
+		os.close(fd)
 
-	if os.path.exists(fileName):
-		print(fileName, 'already exists (will not overwrite)')
+	if not patches:
+		print(image.fileName, 'already has', ', '.join(f'{name}={text}' for name, text in args.exifValues))
 		return
 
-	print('Creating', fileName, '...', end=' ')
-
-	with open(image.fileName, 'rb') as oldFile, open(fileName, 'wb') as newFile:
-
-		newFile.write(oldFile.read(image.exifOffset + tagData.offset))
-		oldFile.read(2)
-
-		b = E.str2(newValue).encode()
-		while b:
-			newFile.write(b)
-			b = oldFile.read(1<<12)
+	fileName = image.fileName
+	if args.copy:
+		name, suffix = fileName.rsplit('.', 1)
+		fileName = '.'.join((name, 'new', suffix))
+		try:
+			reflinkCopy(image.fileName, fileName)
+		except FileExistsError:
+			print(fileName, 'already exists (will not overwrite)')
+			return
 
-		fileInfo = os.fstat(oldFile.fileno())
-		os.fchmod(newFile.fileno(), fileInfo.st_mode)
+	# Overwrite just the bytes of each value
+	fd = os.open(fileName, os.O_WRONLY)
+	try:
+		for name, pos, value in patches:
+			os.pwrite(fd, value, pos)
+	finally:
+		os.close(fd)
 
-	os.utime(fileName, (fileInfo.st_atime, fileInfo.st_mtime))
-	print('Done')
+	os.utime(fileName, ns=(fileInfo.st_atime_ns, fileInfo.st_mtime_ns))
+	print(fileName, 'set', ', '.join(name for name, pos, value in patches))
 
 def printExif(image, args):
 	oneLine = args.one_line
 	image.printExif(oneLine)
 	image.printXMP(oneLine)
 
+imageExtensions = ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.heif', '.avif')
+
+def walkImages(paths, recursive=False):
+	for path in paths:
+		if recursive and os.path.isdir(path):
+			yield from walkImageDir(path)
+		else:
+			yield path
+
+def walkImageDir(dirPath):
+	with os.scandir(dirPath) as it:
+		entries = sorted(it, key=lambda entry: entry.name)
+	for entry in entries:
+		if entry.is_dir(follow_symlinks=False):
+			yield from walkImageDir(entry.path)
+		elif entry.name.lower().endswith(imageExtensions) and entry.is_file():
+			yield entry.path
+
+def jsonValue(tagData):
+	value = tagData.value
+	if isinstance(value, dict):
+		return jsonTags(value)
+	if isinstance(value, bytes):
+		return tagData.valueType.toStr(value)
+	return value
+
+def jsonTags(ifdData):
+	return {str(tagData.name): jsonValue(tagData)
+		for tagData in sorted(ifdData.values(), key=ExifTagData.sortkey)}
+
+def jsonSelectTags(ifdData, tagNames, selected):
+	for tagData in ifdData.values():
+		if isinstance(tagData.value, dict):
+			jsonSelectTags(tagData.value, tagNames, selected)
+		elif str(tagData.name) in tagNames:
+			selected[str(tagData.name)] = jsonValue(tagData)
+	return selected
+
+def jsonRecord(fileName, tagNames=None):
+	record = {'path': fileName}
+	with io.StringIO() as messages:
+		# Warnings go into the record so that they don't end up in the JSON Lines output
+		with contextlib.redirect_stdout(messages), contextlib.redirect_stderr(messages):
+			try:
+				image = Image(fileName)
+				record['format'] = image.format
+				record['size'] = image.size
+				if image.exifData:
+					record['byteOrder'] = image.byteOrder.name
+					if tagNames:
+						record['tags'] = jsonSelectTags(image.exifData, tagNames, {})
+					else:
+						record['tags'] = jsonTags(image.exifData)
+				if image.xmpData and (m := Image.xmpDateCreated.search(image.xmpData)):
+					record['xmpDateCreated'] = m.group(1)
+			except Exception as e:
+				record['error'] = f'{e.__class__.__name__}: {e}'
+		if warnings := messages.getvalue().splitlines():
+			record['warnings'] = warnings
+	return json.dumps(record)
+
+def mapBounded(executor, function, items, window):
+	# Like executor.map, but with at most window items pending at a time, so that the
+	# input is consumed only as fast as the results are
+	pending = deque()
+	for item in items:
+		pending.append(executor.submit(function, item))
+		if len(pending) >= window:
+			yield pending.popleft().result()
+	while pending:
+		yield pending.popleft().result()
+
+def printJsonLines(args):
+	tagNames = frozenset(args.tags.split(',')) if args.tags else None
+	record = partial(jsonRecord, tagNames=tagNames)
+	fileNames = walkImages(args.imagePath, args.recursive)
+	jobs = args.jobs or os.cpu_count()
+
+	if jobs == 1:
+		for fileName in fileNames:
+			print(record(fileName))
+		return
+
+	from concurrent.futures import ProcessPoolExecutor
+	with ProcessPoolExecutor(jobs) as executor:
+		for line in mapBounded(executor, record, fileNames, jobs * 16):
+			print(line)
+
 def main():
 	import argparse
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-o', '--orientation', type=int, default=0, choices=(1,2,3,4,5,6,7,8))
 	parser.add_argument('-l', '--one-line', action='store_true')
+	parser.add_argument('-s', '--set', action='append', default=[], metavar='TAG=VALUE')
+	parser.add_argument('-c', '--copy', action='store_true')
+	parser.add_argument('-r', '--recursive', action='store_true')
+	parser.add_argument('--jsonl', action='store_true')
+	parser.add_argument('-t', '--tags')
+	parser.add_argument('-j', '--jobs', type=int, default=0)
 	parser.add_argument('imagePath', nargs='+')
 	args = parser.parse_args()
 
+	if args.jsonl:
+		if args.orientation or args.set:
+			parser.error('--jsonl can\'t be combined with -o/--orientation or -s/--set')
+		printJsonLines(args)
+		return
+
+	args.exifValues = []
 	if args.orientation != 0:
-		action = setOrientation
+		args.exifValues.append(('Orientation', str(args.orientation)))
+	for assignment in args.set:
+		name, sep, text = assignment.partition('=')
+		if not sep:
+			parser.error(f'--set {assignment} isn\'t TAG=VALUE')
+		args.exifValues.append((name, text))
+
+	if args.exifValues:
+		action = setExifValues
 	else:
 		action = printExif
 
-	for fileName in args.imagePath:
+	for fileName in walkImages(args.imagePath, args.recursive):
 		try:
 			image = Image(fileName)
 		except IOError as e:
@@ -1,44 +1,59 @@
+import contextlib
+from functools import partial
+import io
 import os
+import sys
 import time
-from pimly import Image
+from pimly import Image, mapBounded, walkImages
 
 def formatTime(timestamp):
 	ymdhms = time.localtime(timestamp)[0:6]
 	return "{}-{:02}-{:02} {:02}:{:02}:{:02}".format(*ymdhms)
 
-def setTime(fileName, oldTime, newTime, timeDesc, verbose):
+def setTime(fileName, oldTime, newTime, timeDesc, verbose, dryRun=False):
 	if abs(oldTime - newTime) <= 1:
 		if verbose > 2:
 			print(fileName, 'already has its mod time equal to its', timeDesc)
 		return False
 
+	if dryRun:
+		if verbose > 0:
+			print(fileName, 'mod time would change from', formatTime(oldTime), 'to', formatTime(newTime))
+		return True
+
 	os.utime(fileName, (newTime, newTime))
 	if verbose > 0:
 		print(fileName, 'mod time changed from', formatTime(oldTime), 'to', formatTime(newTime))
 	return True
 
-def setFromExifTime(fileName, verbose=0):
+def setFromExifTime(fileName, verbose=0, dryRun=False):
 	try:
-		image = Image(fileName)
+		exifTime = Image(fileName, timeOnly=True).getTimeCreated()
 	except Exception as e:
 		print(fileName, e.__class__.__name__, str(e))
 		return False
-	exifTime = image.getTimeCreated()
 	if not exifTime:
 		if verbose > 1:
 			print(fileName, "doesn't have Exif DateTimeOriginal")
 		return False
 
-	return setTime(fileName, os.stat(fileName).st_mtime, exifTime, 'Exif time', verbose)
+	return setTime(fileName, os.stat(fileName).st_mtime, exifTime, 'Exif time', verbose, dryRun)
 
-def setFromBirthTime(fileName, verbose=0):
+def setFromBirthTime(fileName, verbose=0, dryRun=False):
 	try:
 		fileInfo = os.stat(fileName)
 	except Exception as e:
 		print(fileName, e.__class__.__name__, str(e))
 		return False
 
-	return setTime(fileName, fileInfo.st_mtime, fileInfo.st_birthtime, 'birth time', verbose)
+	return setTime(fileName, fileInfo.st_mtime, fileInfo.st_birthtime, 'birth time', verbose, dryRun)
+
+def setTimeCaptured(fileName, setTime, verbose, dryRun):
+	# Runs in a worker process, so the output is returned to be printed in order
+	with io.StringIO() as output:
+		with contextlib.redirect_stdout(output):
+			changed = setTime(fileName, verbose, dryRun)
+		return changed, output.getvalue()
 
 def main():
 	import argparse
@@ -46,13 +61,34 @@ def main():
 	parser.add_argument('imagePath', nargs='+')
 	parser.add_argument('--verbose', '-v', action='count', default=0)
 	parser.add_argument('--birthtime', '-b', action='store_true')
+	parser.add_argument('--dry-run', '-n', action='store_true')
+	parser.add_argument('--jobs', '-j', type=int, default=0)
 	args = parser.parse_args()
 	args.verbose += 1
 
-	setTime = setFromBirthTime if args.birthtime else setFromExifTime
+	setTime = partial(setTimeCaptured,
+		setTime=setFromBirthTime if args.birthtime else setFromExifTime,
+		verbose=args.verbose, dryRun=args.dry_run)
+
+	# Directories are walked (recursively) for image files
+	fileNames = walkImages(args.imagePath, recursive=True)
+	jobs = args.jobs or os.cpu_count()
+
+	numFiles = numChanged = 0
+	with contextlib.ExitStack() as stack:
+		if jobs > 1:
+			from concurrent.futures import ProcessPoolExecutor
+			executor = stack.enter_context(ProcessPoolExecutor(jobs))
+			results = mapBounded(executor, setTime, fileNames, jobs * 16)
+		else:
+			results = map(setTime, fileNames)
+		for changed, output in results:
+			sys.stdout.write(output)
+			numFiles += 1
+			numChanged += changed
 
-	for fileName in args.imagePath:
-		setTime(fileName, args.verbose)
+	if args.dry_run:
+		print(f'{numChanged} of {numFiles} file{"s" if numFiles != 1 else ""} would change')
 
 if __name__ == '__main__':
 	main()
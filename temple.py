@@ -1,24 +1,32 @@
+import os
 import re
 
 class TemplateError(Exception):
 	pass
 
+def get_attr(value, attr):
+	if isinstance(value, dict):
+		return value.get(attr, '')
+	if isinstance(value, (list, tuple)):
+		index = int(attr)
+		return value[index] if 0 <= index < len(value) else ''
+	return getattr(value, attr, '')
+
+def to_str(value):
+	if isinstance(value, str):
+		return value
+	if isinstance(value, int):
+		return str(value)
+	return ''
+
 class Variable(object):
 	def __init__(self, name):
 		self.name, *self.attr = name.split('.')
 
 	def eval(self, varmap, *, expected_type=str):
 		value = varmap.get(self.name, '')
-		attrs = self.attr
-		while attrs:
-			attr, *attrs = attrs
-			if isinstance(value, dict):
-				value = value.get(attr, '')
-			elif isinstance(value, (list, tuple)):
-				index = int(attr)
-				value = value[index] if 0 <= index < len(value) else ''
-			else:
-				value = getattr(value, attr, '')
+		for attr in self.attr:
+			value = get_attr(value, attr)
 		if isinstance(value, expected_type):
 			return value
 		if expected_type is str and isinstance(value, int):
@@ -28,6 +36,23 @@ class Variable(object):
 	def write(self, f, varmap):
 		f.write(self.eval(varmap))
 
+	def expr(self):
+		expr = f'get({self.name!r}, \'\')'
+		for attr in self.attr:
+			expr = f'get_attr({expr}, {attr!r})'
+		return expr
+
+	def compile(self, lines, indent):
+		lines.append(f'{indent}write(to_str({self.expr()}))')
+
+	def fold(self, constants):
+		if self.name in constants:
+			try:
+				return self.eval(constants)
+			except ValueError: # Leave the error for when the template is written
+				pass
+		return self
+
 class Conditional(object):
 	def __init__(self, name):
 		self.var = Variable(name)
@@ -40,6 +65,27 @@ class Conditional(object):
 		elif self.else_template:
 			self.else_template.write(f, varmap)
 
+	def compile(self, lines, indent):
+		lines.append(f'{indent}if {self.var.expr()}:')
+		self.template.compile(lines, indent + '\t')
+		if self.else_template:
+			lines.append(f'{indent}else:')
+			self.else_template.compile(lines, indent + '\t')
+
+	def fold(self, constants):
+		self.template.fold(constants)
+		if self.else_template:
+			self.else_template.fold(constants)
+		if self.var.name not in constants:
+			return self
+		try:
+			value = self.var.eval(constants, expected_type=object)
+		except ValueError: # Leave the error for when the template is written
+			return self
+		if value:
+			return self.template
+		return self.else_template or ''
+
 class Loop(object):
 	def __init__(self, loopvar, seqname):
 		self.loopvar = loopvar
@@ -51,6 +97,16 @@ class Loop(object):
 			varmap[self.loopvar] = item
 			self.template.write(f, varmap)
 
+	def compile(self, lines, indent):
+		lines.append(f'{indent}seq = {self.seq.expr()}')
+		lines.append(f'{indent}for item in seq if isinstance(seq, (list, tuple)) else ():')
+		lines.append(f'{indent}\tvarmap[{self.loopvar!r}] = item')
+		self.template.compile(lines, indent + '\t')
+
+	def fold(self, constants):
+		self.template.fold(constants)
+		return self
+
 class Template(object):
 	def __init__(self):
 		self.blocks = []
@@ -70,10 +126,95 @@ class Template(object):
 			return template
 		return self
 
-def parse(data):
+	def compile(self, lines, indent):
+		start = len(lines)
+		text = []
+		for block in self.blocks:
+			if isinstance(block, str):
+				text.append(block)
+				continue
+			if text := ''.join(text):
+				lines.append(f'{indent}write({text!r})')
+			text = []
+			block.compile(lines, indent)
+		if text := ''.join(text):
+			lines.append(f'{indent}write({text!r})')
+		if len(lines) == start:
+			lines.append(f'{indent}pass')
+
+	def fold(self, constants):
+		"""Evaluate the variables and conditionals that depend only on constants, and join
+		the literal text around them (and any other adjacent literal text) into one string."""
+		blocks = []
+		for block in self.blocks:
+			if not isinstance(block, str):
+				block = block.fold(constants)
+			for b in block.blocks if isinstance(block, Template) else (block,):
+				if not isinstance(b, str):
+					blocks.append(b)
+				elif blocks and isinstance(blocks[-1], str):
+					blocks[-1] += b
+				elif b:
+					blocks.append(b)
+		self.blocks = blocks
+		return self
+
+	def loop_vars(self):
+		for block in self.blocks:
+			if isinstance(block, Loop):
+				yield block.loopvar
+			for template in (getattr(block, 'template', None), getattr(block, 'else_template', None)):
+				if template:
+					yield from template.loop_vars()
+
+	def python_source(self):
+		"""Return the source of a Python function render(f, varmap) equivalent to self.write."""
+		lines = [
+			'def render(f, varmap):',
+			'\tget = varmap.get',
+			'\tout = []',
+			'\twrite = out.append',
+		]
+		self.compile(lines, '\t')
+		lines.append('\tf.write(\'\'.join(out))')
+		return '\n'.join(lines) + '\n'
+
+class CompiledTemplate(object):
+	def __init__(self, template):
+		self.source = template.python_source()
+		self.code = compile(self.source, '<template>', 'exec')
+		namespace = {'get_attr': get_attr, 'to_str': to_str}
+		exec(self.code, namespace)
+		self.write = namespace['render']
+
+def read_file(name):
+	with open(name) as file:
+		return file.read()
+
+def parse(data, compile=False, constants=None, include=read_file, path=None):
+	"""Parse data into a Template (or a CompiledTemplate if compile is true).
+
+	<?include name> is replaced by the template that include(name) returns, where name is
+	relative to the directory of the including file (path, if given, is data's file name,
+	and otherwise names are relative to the current directory). Variables and
+	conditionals that depend only on names in constants are evaluated at parse time, so
+	the same constants must be passed in the varmap when the template is written. A name
+	that's also used as a loop variable is never treated as a constant.
+	"""
+	if path:
+		template = parse_template(data, include, (os.path.normpath(path),), os.path.dirname(path))
+	else:
+		template = parse_template(data, include, (), '')
+	if constants:
+		loop_vars = set(template.loop_vars())
+		template.fold({k: v for k, v in constants.items() if k not in loop_vars})
+	return CompiledTemplate(template) if compile else template
+
+def parse_template(data, include, included, directory):
 	pattern_var = '[a-z][0-9_a-z]*(?:\\.[0-9_a-z]+)*'
 	pattern_cond = re.compile('if ' + pattern_var)
 	pattern_loop = re.compile('for [a-z][0-9_a-z]* in ' + pattern_var)
+	pattern_include = re.compile('include [0-9A-Za-z_][0-9A-Za-z_./-]*')
 	pattern_var = re.compile(pattern_var)
 
 	template = Template()
@@ -108,6 +249,19 @@ def parse(data):
 		elif pattern_loop.fullmatch(code):
 			code = code.split()
 			template = template.add(Loop(code[1], code[3]))
+		elif pattern_include.fullmatch(code):
+			name = os.path.normpath(os.path.join(directory, code.split()[1]))
+			if name in included: err(f'Recursive <?{code}>')
+			try:
+				included_data = include(name)
+			except OSError as error:
+				err(f'Cannot <?{code}> ({error.strerror})')
+			try:
+				included_template = parse_template(included_data, include, (*included, name),
+					os.path.dirname(name))
+			except TemplateError as error:
+				raise TemplateError(f'{name}: {error}') from None
+			template.blocks.extend(included_template.blocks)
 		else:
 			err(f'Malformed <?{code}>')
 		i = j + 1